@@ -12,4 +12,4 @@ for directory in ['logs', 'results', 'data', 'tensorboard']:
 from . import utils, keras_utils, artificial
 from . import models
 
-__all__ = ['artificial', 'household', 'keras_utils', 'utils', 'config', 'models']
\ No newline at end of file
+__all__ = ['artificial', 'household', 'keras_utils', 'utils', 'config', 'models', 'shared', 'inference', 'serving', 'backtest', 'preprocessing']
\ No newline at end of file
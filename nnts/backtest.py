@@ -0,0 +1,145 @@
+"""
+This file provides bulk backtesting of trained models.
+
+backtest slides over any range of a generator's series (including the test
+share) with large strided batches of samples built directly by the
+generator's _get_batch, streams the predictions into a (possibly memory
+mapped) array, maps them back to the original units of the series (undoing
+the normalization and the 1st differences) and accumulates the error
+metrics batch by batch.
+"""
+from ._imports_ import *
+from . import inference
+from .config import WDIR
+
+
+def _steps(y, n, h):
+    """
+    Returns predictions or targets (as returned by the network or io_func)
+    as an array of shape (n, h, no. of target columns).
+    """
+    if type(y) == dict:
+        y = y['main_output']
+    if type(y) == list:
+        y = y[0]
+    return np.asarray(y).reshape(n, h, -1)
+
+
+def _predict(nn, inp, batch_size):
+    if isinstance(nn, inference.Predictor):
+        x, v = inference._split_inputs(inp)
+        return nn.predict(x, value_input=v)
+    return nn.predict(inp, batch_size=batch_size)
+
+
+class Inverter(object):
+    """
+    Class that maps normalized (and differenced) values of the target columns
+    of a generator back to the original units of the series.
+    Initialization arguments:
+        G           - nnts.utils.Generator object
+        cols        - target columns (as passed to G.get_target_col_ids)
+    """
+    def __init__(self, G, cols):
+        names = list(G.get_target_col_ids(cols=cols, ids=False))
+        if getattr(G, 'means', None) is not None:
+            stds = G.stds.reindex(names)
+            self.mean = np.asarray(G.means.reindex(names).fillna(0), dtype=np.float64)
+            self.std = np.asarray((stds + (stds == 0)*.001).fillna(1), dtype=np.float64)
+        else:
+            self.mean, self.std = np.zeros(len(names)), np.ones(len(names))
+        base = getattr(G, 'diff_base', None)
+        self.diffed = np.zeros(len(names), dtype=bool) if (base is None) else \
+                      np.asarray(base.reindex(names).notna())
+        self.levels = None
+        if self.diffed.any():
+            # levels[j] - raw value preceding row j of the differenced series
+            # asarray, as event-encoded generators (e.g. household) keep no dense X
+            d = np.asarray(G.asarray([c for c, f in zip(names, self.diffed) if f]), dtype=np.float64)
+            d = d * self.std[self.diffed] + self.mean[self.diffed]
+            self.levels = np.empty((d.shape[0] + 1, d.shape[1]))
+            self.levels[0] = np.asarray(base.reindex(names))[self.diffed]
+            np.cumsum(d, axis=0, out=self.levels[1:])
+            self.levels[1:] += self.levels[0]
+
+    def __call__(self, y, idx):
+        """
+        Arguments:
+            y           - (numpy.array) of shape (no. of samples, steps, no. of
+                          target columns) of normalized values
+            idx         - (numpy.array) indices of the first row of y of each
+                          sample in the generator's series
+        Returns
+            numpy.array of y in original units
+        """
+        y = y * self.std + self.mean
+        if self.levels is not None:
+            y[:, :, self.diffed] = self.levels[idx][:, None, :] + np.cumsum(y[:, :, self.diffed], axis=1)
+        return y
+
+
+def backtest(nn, G, io_func, cols='default', start=0, end=None, stride=1, batch_size=4096,
+             predict_batch_size=1024, filename=None, unscale=True, verbose=1):
+    """
+    Function that computes the rolling forecasts of a trained network over
+    a range of the series.
+    Arguments:
+        nn          - trained network (keras.models.Model or
+                      nnts.inference.Predictor)
+        G           - generator the network was trained with
+        io_func     - io function of the model (see Generator.make_io_func)
+        cols        - target columns of the model
+        start, end  - range of rows of the series covered by the samples
+                      (default: the whole series)
+        stride      - step between consecutive samples (e.g. output_length for
+                      non-overlapping multi-step forecasts)
+        batch_size  - no. of samples built at once
+        predict_batch_size - batch size passed to keras predict
+        filename    - if not None, predictions are written to a .npy file of
+                      that name (relative to WDIR), which is returned memory
+                      mapped
+        unscale     - if True, predictions and errors are in the original units
+                      of the series (normalization and differences undone)
+    Returns
+        dictionary with
+            'index'         - index of the first predicted row of each sample
+            'predictions'   - numpy.array of shape (no. of samples,
+                              output_length, no. of target columns)
+            'mse', 'mae'    - mean squared / absolute errors of each step and
+                              target column, of shape (output_length, no. of
+                              target columns)
+    """
+    t0 = time.time()
+    il, ol = G.input_length, G.output_length
+    if end is None:
+        end = len(G.X) if (getattr(G, 'X', None) is not None) else (G.n_test if G.test else G.n_valid)
+    idx = np.arange(start + il, end - ol + 1, stride)
+    inverse = Inverter(G, cols) if unscale else None
+    offsets = getattr(io_func, 'offsets', None)
+    predictions, se, ae = None, 0., 0.
+    for b in range(0, len(idx), batch_size):
+        bidx = idx[b: b + batch_size]
+        x = G._get_batch(bidx, offsets=offsets)
+        inp, target = io_func(x) if (offsets is None) else io_func(x, gathered=True)
+        y = _steps(_predict(nn, inp, predict_batch_size), len(bidx), ol)
+        target = _steps(target, len(bidx), ol)
+        if unscale:
+            y, target = inverse(y, bidx), inverse(target, bidx)
+        if predictions is None:
+            shape = (len(idx),) + y.shape[1:]
+            if filename is None:
+                predictions = np.empty(shape, dtype=np.float32)
+            else:
+                predictions = np.lib.format.open_memmap(os.path.join(WDIR, filename), mode='w+',
+                                                        dtype=np.float32, shape=shape)
+        predictions[b: b + len(bidx)] = y
+        se = se + ((y - target)**2).sum(axis=0)
+        ae = ae + np.abs(y - target).sum(axis=0)
+    if isinstance(predictions, np.memmap):
+        predictions.flush()
+    results = {'index': idx, 'predictions': predictions, 'mse': se / max(len(idx), 1),
+               'mae': ae / max(len(idx), 1)}
+    if verbose > 0:
+        print('time = %.2fs, %d forecasts, mse = %.5f, mae = %.5f' %
+              (time.time() - t0, len(idx), np.mean(results['mse']), np.mean(results['mae'])))
+    return results
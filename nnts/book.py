@@ -5,6 +5,7 @@ Created on Tue Jul  4 18:56:31 2017
 @author: mbinkowski
 """
 from ._imports_ import *
+from . import utils
 from .config import WDIR
 from keras import backend as K
 
@@ -29,12 +30,29 @@ class BookGenerator(utils.Generator):
         self._vcids = self.get_target_col_ids(cols=self._vcols)
         self.__scale()
         self.X['mean'] = .5 * (self.X['current_bid'] + self.X['current_ask'])
+        self._arr = self.asarray()
+        self._mean = np.asarray(self.X['mean'], dtype=np.float32)
+        self._window = np.arange(-self.input_length, self.output_length)
         
     def _get_ith_sample(self, i):
-        ref = self.X.loc[i].copy()
-        ref[self._vcols] = ref['mean']
-        ref[self._ccols] = 0
-        return np.array(self.X.loc[i - self.input_length: i + self.output_length - 1, self.cols] - ref[self.cols])
+        return self._get_batch(np.array([i]))[0]
+    
+    def _get_batch(self, idx, offsets=None, out=None):
+        """
+        Gathers the windows of all samples (or only their timesteps given by
+        offsets) in one take from the float32 copy of the table and 
+        subtracts the reference rows (mean price for the value columns, 
+        0 for the count columns) in place.
+        """
+        window = self._window if (offsets is None) else self._window[offsets]
+        # take buffers 'out' in 'raise' mode; the indices are in range anyway
+        x = np.take(self._arr, idx[:, None] + window, axis=0, out=out, 
+                    mode='raise' if (out is None) else 'clip')
+        ref = self._arr[idx]
+        ref[:, self._vcids] = self._mean[idx, None]
+        ref[:, self._ccids] = 0
+        x -= ref[:, None, :]
+        return x
     
     def get_target_col_ids(self, ids=True, cols='default'):
         if cols in ['all', 'default']:
@@ -42,7 +60,7 @@ class BookGenerator(utils.Generator):
         assert type(cols) == list
         return [(i if ids else c) for i, c in enumerate(self.cols) if c in cols]
         
-    def _scale(self):
+    def _scale(self, **kwargs):
         pass
     
     def __scale(self):
@@ -58,6 +76,7 @@ class BookGenerator(utils.Generator):
         il = self.input_length
         cols = self.get_target_col_ids(cols)
         if 'exp_time' in io_form:
+            tcols = utils.as_slice(cols)
             times, t = [], self.output_length
             while t >= 1:
                 times.append(il - 1 + t)
@@ -65,9 +84,12 @@ class BookGenerator(utils.Generator):
             if io_form == '0+exp_time':
                 times.append(il)
             times = times[::-1]
-            def regr(x):
+            def regr(x, gathered=False):
+                # gathered - x holds only the rows given by regr.offsets
+                t = slice(il, None) if gathered else times
                 return (x[:, :il, :] if (input_cols is None) else x[:, : il, input_cols],
-                        x[:, times, :][:, :, cols])
+                        x[:, t, :][:, :, tcols])
+            regr.offsets = np.concatenate([np.arange(il), times])
             return regr
         else:
             return super(BookGenerator, self).make_io_func(io_form, cols, input_cols)
@@ -84,6 +84,13 @@ class HouseholdGenerator(Generator):
     
 
 class HouseholdAsynchronousGenerator(HouseholdGenerator):
+    """
+    Class that provides sample generator for the asynchronous version of the 
+    Household Electricity Dataset, where at each timestep only one randomly 
+    chosen source is observed. The series is stored as (time, source id, 
+    value) events; dense input windows are built only per batch.
+    
+    """
     def __init__(self, filename=os.path.join('data', 'household_async.pkl'), 
                  url='https://archive.ics.uci.edu/ml/machine-learning-databases/00235/household_power_consumption.zip',
                  train_share=(.8, 1.), input_length=1, output_length=1, verbose=1, 
@@ -108,12 +115,18 @@ class HouseholdAsynchronousGenerator(HouseholdGenerator):
             print('Generating new asynchronous sampling schedue')
             schedule = self.generate_schedule(X.shape, duration_type=duration_type)
             schedule.to_pickle(os.path.join(WDIR, self.schedule_file))
-        X.index = np.arange(X.shape[0])
-        X['value'] = 0.
-        for c in self.value_cols:
-            X['value'] += X[c] * schedule[c + '_ind']
-        X = pd.concat([X, schedule], axis=1)
-        X = X.loc[X[self.ind_cols].sum(axis=1) > 0, :]
+        # reduce the schedule to the observed rows' source ids and build the
+        # event arrays directly from the raw readings
+        schedule = np.asarray(schedule[self.ind_cols], dtype=np.float32)
+        keep = schedule.sum(axis=1) > 0
+        if limit < np.inf:
+            keep[int(limit) + 1:] = False
+        self._sources = np.asarray(np.argmax(schedule[keep], axis=1), dtype=np.uint8)
+        del schedule
+        self.targets = np.asarray(X[self.value_cols], dtype=np.float32)[keep]
+        self.times = np.asarray(X['time'], dtype=np.float32)[keep]
+        self.values = self.targets[np.arange(len(self._sources)), self._sources]
+        X = pd.DataFrame({'datetime': X['datetime'].values[keep]}, index=np.flatnonzero(keep))
         
         super(HouseholdGenerator, self).__init__(X, train_share=train_share, 
                                                 input_length=input_length, 
@@ -124,8 +137,78 @@ class HouseholdAsynchronousGenerator(HouseholdGenerator):
                                                 diffs=diffs)        
         
         self.cols = self.value_cols + self.ind_cols + ['time', 'value']
+        self._to_events()
+        
+    def _dense(self, a, b):
+        """
+        Returns raw rows a to b (exclusive) of the columns value_cols, ind_cols,
+        time and value, before differencing and normalization.
+        """
+        eye = np.eye(len(self.value_cols), dtype=np.float32)
+        return np.concatenate([self.targets[a: b], eye[self._sources[a: b]],
+                               self.times[a: b, None], self.values[a: b, None]], axis=1)
+        
+    def _scale(self, exclude=None, exclude_diff=None, block=65536):
+        """
+        Takes the 1st differences (if self.diffs) of the event arrays and 
+        normalizes them with the training share means and stds, which are 
+        accumulated block-wise over the rows of the implied dense table, so 
+        that the table itself is never built. 
+        """
+        cols = self.value_cols + self.ind_cols + ['time', 'value']
+        n, index = len(self._sources), self.X.index
+        self.diff_base = None
+        if self.diffs:
+            self.diff_base = pd.Series(self._dense(0, 1)[0], index=cols, dtype=np.float64)
+            index = index[1:]
+        # rows labelled up to n_train, as in X.loc[:n_train]
+        n_train = index.slice_locs(None, self.n_train)[1]
+        moments = RunningMoments(len(cols))
+        for b in range(0, n_train, block):
+            e = min(b + block, n_train)
+            moments.update(np.diff(self._dense(b, e + 1), axis=0) if self.diffs else self._dense(b, e))
+        self.means = pd.Series(moments.mean, index=cols)
+        self.stds = pd.Series(moments.std(ddof=1), index=cols)
+        stds = self.stds + (self.stds == 0)*.001
+        for arr, c in [(self.targets, self.value_cols), (self.times, 'time'), (self.values, 'value')]:
+            if self.diffs:
+                for end in range(n, 1, -block):
+                    b = max(1, end - block)
+                    arr[b: end] -= arr[b - 1: end - 1]
+            arr -= np.asarray(self.means[c], dtype=np.float32)
+            arr /= np.asarray(stds[c], dtype=np.float32)
+        if self.diffs:
+            self.targets, self.times, self.values = self.targets[1:], self.times[1:], self.values[1:]
+            self.X = pd.DataFrame({'datetime': self.X['datetime'].diff().values[1:]}, index=index)
+        
+    def _to_events(self):
+        """
+        Sets the source ids of the (time, source id, value) events. Indicator 
+        columns are restored batch-wise in _get_batch from the source ids and 
+        the indicators' means and stds.
+        """
+        sources = self._sources
+        del self._sources
+        if self.diffs:
+            # differenced indicators are one-hot(current) - one-hot(previous)
+            self.sources, self.prev_sources = sources[1:], sources[:-1]
+        else:
+            self.sources, self.prev_sources = sources, None
+        stds = np.array(self.stds[self.ind_cols])
+        stds += (stds == 0) * .001
+        self._ind_offset = np.asarray(-np.array(self.means[self.ind_cols]) / stds, dtype=np.float32)
+        self._ind_step = np.asarray(1. / stds, dtype=np.float32)
+        
+    def asarray(self, cols=None):
+        """
+        Returns the normalized (and differenced) series of columns 'cols' 
+        (default: self.cols), as the dense table would hold them.
+        """
+        if cols is None:
+            cols = self.cols
+        x = self._get_batch(np.arange(len(self.sources)) + self.input_length, offsets=[0])[:, 0, :]
+        return x[:, [self.cols.index(c) for c in cols]]
 
-           
     def generate_schedule(self, shape, duration_type='deterministic'):
         N, d = shape
         frequencies = np.random.permutation(1.5**np.arange(d - 2))
@@ -143,6 +226,27 @@ class HouseholdAsynchronousGenerator(HouseholdGenerator):
         schedule *= valid.reshape(N, 1)
         return pd.DataFrame(schedule, columns=[c +'_ind' for c in self.value_cols])
         
+    def _get_ith_sample(self, i):
+        return self._get_batch(np.array([i]))[0]
+        
+    def _get_batch(self, idx, offsets=None, out=None):
+        rows = idx[:, None] + np.arange(-self.input_length, self.output_length)
+        if offsets is not None:
+            rows = rows[:, offsets]
+        nv = len(self.value_cols)
+        x = np.empty(rows.shape + (len(self.cols),), dtype=np.float32) if (out is None) else out
+        x[:, :, :nv] = self.targets[rows]
+        x[:, :, nv: 2*nv] = self._ind_offset
+        b, t = np.ogrid[:rows.shape[0], :rows.shape[1]]
+        s = self.sources[rows]
+        x[b, t, nv + s] += self._ind_step[s]
+        if self.prev_sources is not None:
+            s = self.prev_sources[rows]
+            x[b, t, nv + s] -= self._ind_step[s]
+        x[:, :, -2] = self.times[rows]
+        x[:, :, -1] = self.values[rows]
+        return x
+        
     def make_io_func(self, io_form, cols='default', input_cols=None):
         if input_cols is None:
             input_cols = ['value', 'time'] + self.ind_cols
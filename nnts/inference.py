@@ -0,0 +1,893 @@
+"""
+This file provides numpy-only streaming inference for the convolutional
+models (CNNmodel and SOCNNmodel) and the stateful LSTMmodel.
+
+The weights of a trained keras network are extracted into 'specs' (plain
+dictionaries of numpy arrays, with batch normalization folded into the
+preceding convolutions). StreamingPredictor then forecasts after every new
+observation without recomputing the whole input window: it keeps the
+activations of each layer and, when the window slides, reuses those of the
+interior positions, recomputing only the positions near the window's edges
+(the ones that see the new observations or the zero padding). Per update,
+the convolutions cost O(layers x kernel) instead of O(input_length x layers).
+
+With max pooling, the windows of ticks t and t - P (P - product of the pool
+sizes) are aligned on all layers, so one set of activations is kept for every
+phase t mod P.
+
+LSTMSession keeps the LSTM hidden and cell states of many series in a compact
+array store and advances any subset of them by one observation in a single
+batched step.
+
+export saves the specs of a trained network (save - any specs, e.g.
+quantized ones) to a single .npz file and load restores a predictor from it,
+importing nothing but numpy (this file does not depend on the rest of the
+package), so that predictions start in milliseconds without building the
+keras graph.
+
+rollout forecasts several steps recursively with a one-step network, for
+comparison with the direct multi-step networks (output_length > 1).
+
+quantize converts the weights of LR, CNN and SOCNN specs to float16 or to int8
+with per-channel scales and quantization_report compares the accuracy and the
+memory of the quantized networks with the float ones. Predictors hold only
+the quantized weights and dequantize them one layer at a time during the
+forward pass (float16 upcast, int8 scaled), accumulating in float32.
+"""
+import copy
+import json
+import time
+import numpy as np
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+    'tanh': np.tanh,
+    'softplus': lambda x: np.logaddexp(0, x),
+    'hard_sigmoid': lambda x: np.clip(.2 * x + .5, 0, 1),
+    'softmax': lambda x: softmax(x),
+}
+
+
+def activate(x, act):
+    """
+    Arguments:
+        x           - numpy.array
+        act         - [activation name, alpha] as stored in specs
+    """
+    name, alpha = act
+    if name == 'leakyrelu':
+        return np.where(x > 0, x, alpha * x)
+    return ACTIVATIONS[name](x)
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - x.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def weights(d, name):
+    """
+    Returns float32 weights d[name], dequantizing int8 weights with their
+    per-channel scales d[name + '_scale'] and upcasting float16 ones (see
+    quantize); the copy lives only while the layer is computed.
+    """
+    w = d[name]
+    if w.dtype == np.int8:
+        return w.astype(np.float32) * d[name + '_scale']
+    return w.astype(np.float32, copy=False)
+
+
+def _chain(layers):
+    """
+    Function that converts a sequence of keras layers to the list of stages
+    used by StreamingPredictor.
+    """
+    chain = []
+    for l in layers:
+        kind, cfg = l.__class__.__name__, l.get_config()
+        if kind == 'Conv1D':
+            k, d = cfg['kernel_size'][0], cfg['dilation_rate'][0]
+            if cfg['strides'][0] != 1:
+                raise NotImplementedError('strided convolutions are not supported')
+            pad = {'same': [(k - 1)*d//2, (k - 1)*d - (k - 1)*d//2],
+                   'causal': [(k - 1)*d, 0], 'valid': [0, 0]}[cfg['padding']]
+            w = l.get_weights()
+            chain.append({'type': 'conv', 'kernel': np.asarray(w[0], dtype=np.float32),
+                          'bias': np.asarray(w[1] if cfg['use_bias'] else np.zeros(w[0].shape[2]),
+                                             dtype=np.float32),
+                          'pad': pad, 'dilation': int(d),
+                          'acts': [] if (cfg['activation'] == 'linear') else [[cfg['activation'], 0.]]})
+        elif kind == 'BatchNormalization':
+            if (len(chain) == 0) or (chain[-1]['type'] != 'conv') or chain[-1]['acts']:
+                raise NotImplementedError('batch normalization is only folded into a preceding convolution')
+            w = list(l.get_weights())
+            gamma = w.pop(0) if cfg['scale'] else 1.
+            beta = w.pop(0) if cfg['center'] else 0.
+            mean, var = w
+            scale = gamma / np.sqrt(var + cfg['epsilon'])
+            chain[-1]['kernel'] = (chain[-1]['kernel'] * scale).astype(np.float32)
+            chain[-1]['bias'] = (chain[-1]['bias'] * scale + beta - mean * scale).astype(np.float32)
+        elif kind == 'LeakyReLU':
+            chain[-1]['acts'].append(['leakyrelu', float(cfg['alpha'])])
+        elif kind == 'Activation':
+            chain[-1]['acts'].append([cfg['activation'], 0.])
+        elif kind == 'MaxPooling1D':
+            p = cfg['pool_size'][0]
+            if (cfg['strides'][0] != p) or (cfg['padding'] != 'valid'):
+                raise NotImplementedError('only non-overlapping valid max pooling is supported')
+            chain.append({'type': 'pool', 'size': int(p), 'acts': []})
+        elif kind == 'Dropout':
+            continue
+        else:
+            raise NotImplementedError('layer ' + kind + ' not supported')
+    return chain
+
+
+def _dense(l):
+    """
+    Function that converts a keras Dense layer (or TimeDistributed Dense) to
+    a dictionary of its weights and activation.
+    """
+    cfg, w = l.get_config(), l.get_weights()
+    act = cfg['layer']['config']['activation'] if ('layer' in cfg) else cfg['activation']
+    return {'kernel': np.asarray(w[0], dtype=np.float32),
+            'bias': np.asarray(w[1] if (len(w) > 1) else np.zeros(w[0].shape[1]), dtype=np.float32),
+            'acts': [] if (act == 'linear') else [[act, 0.]]}
+
+
+def extract_specs(nn):
+    """
+    Function that extracts the weights of a trained LRmodel, CNNmodel,
+    SOCNNmodel or LSTMmodel network.
+    Arguments:
+        nn          - keras.models.Model object
+    Returns
+        dictionary with 'kind' ('lr', 'cnn', 'socnn' or 'lstm'), 'input_length' and
+        the stages and head weights of the network
+    """
+    layers = [l for l in nn.layers if l.__class__.__name__ != 'InputLayer']
+    if any('residual' in l.name for l in layers):
+        raise NotImplementedError('residual connections (resnet=True) are not supported')
+    shapes = nn.input_shape if (type(nn.input_shape) == list) else [nn.input_shape]
+    specs = {'input_length': int(shapes[0][1])}
+    kinds = [l.__class__.__name__ for l in layers]
+    if kinds == ['Dense']:
+        specs['kind'] = 'lr'
+        specs['dense'] = _dense(layers[0])
+    elif 'LSTM' in kinds:
+        specs['kind'] = 'lstm'
+        lstm = layers[kinds.index('LSTM')]
+        if kinds.count('LSTM') > 1:
+            raise NotImplementedError('only a single LSTM layer is supported')
+        cfg, w = lstm.get_config(), lstm.get_weights()
+        units = cfg['units']
+        specs['lstm'] = {'kernel': np.asarray(w[0], dtype=np.float32),
+                         'recurrent_kernel': np.asarray(w[1], dtype=np.float32),
+                         'bias': np.asarray(w[2] if cfg['use_bias'] else np.zeros(4 * units),
+                                            dtype=np.float32),
+                         'activation': cfg['activation'] or 'linear',
+                         'recurrent_activation': cfg['recurrent_activation'] or 'linear'}
+        specs['acts'] = []
+        for l in layers[kinds.index('LSTM') + 1:]:
+            if l.__class__.__name__ == 'LeakyReLU':
+                specs['acts'].append(['leakyrelu', float(l.get_config()['alpha'])])
+            elif l.__class__.__name__ == 'Activation':
+                specs['acts'].append([l.get_config()['activation'], 0.])
+            elif l.name == 'tddense':
+                specs['dense'] = _dense(l)
+    elif any(l.name.startswith('significance') for l in layers):
+        specs['kind'] = 'socnn'
+        specs['sigs'] = _chain([l for l in layers if l.name.startswith('significance')
+                                and (l.name != 'significancemerge')])
+        specs['offs'] = _chain([l for l in layers if l.name.startswith('offset')])
+        names = [l.name for l in layers]
+        specs['weighting'] = 'softmax' if ('softmax' in names) else \
+                             ('lambda' if ('relulambda' in names) else None)
+        odim, L = int(shapes[1][2]), specs['input_length']
+        lc = [l for l in layers if l.__class__.__name__ == 'LocallyConnected1D']
+        if lc:
+            kernel, bias = lc[0].get_weights()
+        else:
+            kernel = [l for l in layers if l.name == 'out'][0].get_weights()[0]
+            kernel = np.broadcast_to(kernel, (odim,) + kernel.shape)
+            bias = np.zeros((odim, kernel.shape[2]))
+        specs['out'] = {'kernel': np.asarray(kernel, dtype=np.float32).reshape(odim, L, -1),
+                        'bias': np.asarray(bias, dtype=np.float32)}
+    elif 'Flatten' in kinds:
+        specs['kind'] = 'cnn'
+        flat = kinds.index('Flatten')
+        specs['chain'] = _chain(layers[:flat])
+        specs['dense'] = _dense(layers[flat + 1])
+    else:
+        raise NotImplementedError('network not supported')
+    return specs
+
+
+def _geometry(chain, length):
+    """
+    Function that computes, for every stage of a chain applied to windows of
+    the given length: its output length, the number of positions to
+    recompute at the left ('left') and at the right edge ('right') when the
+    window slides by P (product of the pool sizes) and the corresponding
+    shift of the stage's output ('shift').
+    """
+    P = int(np.prod([st['size'] for st in chain if st['type'] == 'pool']))
+    n, left, right, stride = length, 0, P, 1
+    geo = []
+    for st in chain:
+        if st['type'] == 'conv':
+            k = st['kernel'].shape[0]
+            pl, pr = st['pad']
+            n = n + pl + pr - (k - 1) * st['dilation']
+            left, right = left + pl, right + pr
+        else:
+            p = st['size']
+            n_in, n = n, n // p
+            left = -(-left // p)
+            right = n - (-(-(n_in - right - p + 1) // p))
+            stride *= p
+        left, right = min(max(left, 0), n), min(max(right, 0), n)
+        geo.append({'length': n, 'left': left, 'right': right, 'shift': P // stride})
+    return geo, P
+
+
+def stage_rows(st, x, pos):
+    """
+    Function that computes the outputs of stage 'st' at positions 'pos' from
+    its full input 'x' (array of shape (input length, channels), optionally
+    with leading batch dimensions).
+    """
+    n = x.shape[-2]
+    if st['type'] == 'conv':
+        k = st['kernel'].shape[0]
+        idx = pos[:, None] - st['pad'][0] + np.arange(k) * st['dilation']
+        ok = (idx >= 0) & (idx < n)
+        g = np.take(x, np.clip(idx, 0, n - 1), axis=-2) * ok[:, :, None]
+        y = np.tensordot(g, weights(st, 'kernel'), axes=([-2, -1], [0, 1])) + st['bias']
+    else:
+        p = st['size']
+        y = np.take(x, pos[:, None] * p + np.arange(p), axis=-2).max(axis=-2)
+    for act in st['acts']:
+        y = activate(y, act)
+    return y
+
+
+def _chains(specs):
+    """
+    Returns the list of the convolutional chains of LR, CNN or SOCNN specs.
+    """
+    if specs['kind'] == 'lr':
+        return [[]]
+    if specs['kind'] == 'cnn':
+        return [specs['chain']]
+    if specs['kind'] == 'socnn':
+        return [specs['sigs'], specs['offs']]
+    raise NotImplementedError('inference for ' + specs['kind'] + ' not supported')
+
+
+def _flat(x):
+    return x.reshape(x.shape[:-2] + (-1,))
+
+
+def _main(specs, outs, values):
+    """
+    Returns the significance-weighted values of SOCNN (the input of its last
+    layer), of shape (..., odim, input_length).
+    """
+    sig = np.swapaxes(outs[0], -1, -2)
+    if specs['weighting'] == 'softmax':
+        sig = softmax(sig, axis=-1)
+    elif specs['weighting'] == 'lambda':
+        sig = np.logaddexp(0, sig)
+        sig = sig / sig.sum(axis=-1, keepdims=True)
+    return sig * np.swapaxes(outs[1] + values, -1, -2)
+
+
+class _Window(object):
+    """
+    Array of rows that slides forward with amortized O(1) cost per shift.
+    """
+    def __init__(self, length, dim):
+        self.length = length
+        self.data = np.zeros((2 * length, dim), dtype=np.float32)
+        self.start = 0
+
+    def view(self):
+        return self.data[self.start: self.start + self.length]
+
+    def shift(self, s):
+        if s >= self.length:
+            self.start = 0
+        elif self.start + s + self.length > len(self.data):
+            self.data[:self.length - s] = self.data[self.start + s: self.start + self.length]
+            self.start = 0
+        else:
+            self.start += s
+
+
+class Predictor(object):
+    """
+    Class that computes the forecasts of an LRmodel, CNNmodel or SOCNNmodel
+    network given by specs (see extract_specs) for batches of full input
+    windows.
+    Initialization arguments:
+        specs       - dictionary returned by extract_specs
+        input_cols  - indices of the columns of the observed rows fed to the
+                      network (None - all)
+        value_cols  - indices of the predicted columns in the observed rows
+                      (value_input of SOCNN); if None, the ones stored in
+                      specs by export are used
+    """
+    def __init__(self, specs, input_cols=None, value_cols=None):
+        self.specs = specs
+        self.input_length = specs['input_length']
+        self.input_cols = input_cols
+        self.value_cols = specs.get('value_cols') if (value_cols is None) else value_cols
+        self.chains = _chains(specs)
+
+    def _head(self, outs, values):
+        specs = self.specs
+        if specs['kind'] in ['lr', 'cnn']:
+            y = _flat(outs[0]).dot(weights(specs['dense'], 'kernel')) + specs['dense']['bias']
+            for act in specs['dense']['acts']:
+                y = activate(y, act)
+            return y
+        main = _main(specs, outs, values)
+        out = np.einsum('...sc,scf->...sf', main, weights(specs['out'], 'kernel')) + specs['out']['bias']
+        return np.swapaxes(out, -1, -2)
+
+    def _chains(self, x):
+        """
+        Returns the outputs of the convolutional chains for input windows x.
+        """
+        outs = []
+        for chain in self.chains:
+            h = x
+            for st, g in zip(chain, _geometry(chain, self.input_length)[0]):
+                h = stage_rows(st, h, np.arange(g['length']))
+            outs.append(h)
+        return outs
+
+    def _inputs(self, x, value_input=None):
+        x = np.asarray(x, dtype=np.float32)
+        if self.specs['kind'] == 'lr':
+            x = x[..., None, :]
+        if (self.specs['kind'] == 'socnn') and (value_input is None):
+            if self.value_cols is None:
+                raise ValueError('value_input or value_cols have to be given for SOCNN')
+            value_input = x[..., self.value_cols]
+        if self.input_cols is not None:
+            x = x[..., self.input_cols]
+        return x, None if (value_input is None) else np.asarray(value_input, dtype=np.float32)
+
+    def predict(self, x, value_input=None):
+        """
+        Function that computes the forecasts for full input windows.
+        Arguments:
+            x           - (numpy.array) of shape (input_length, row dimension)
+                          (for LR flattened to input_length), optionally with
+                          a leading batch dimension
+            value_input - (numpy.array) value_input of SOCNN; if None, taken
+                          from x[..., value_cols]
+        Returns
+            numpy.array; for LR and CNN the flat output of the Dense layer,
+            for SOCNN main_output of shape (output_length, no. of predicted
+            columns), with the leading batch dimension of x
+        """
+        x, value_input = self._inputs(x, value_input)
+        return self._head(self._chains(x), value_input)
+
+
+class StreamingPredictor(Predictor):
+    """
+    Class that produces the forecast after every new observation of a series
+    for a convolutional network given by specs (see extract_specs).
+    Initialization arguments as of Predictor.
+    """
+    def __init__(self, specs, input_cols=None, value_cols=None):
+        super(StreamingPredictor, self).__init__(specs, input_cols=input_cols, value_cols=value_cols)
+        if specs['kind'] not in ['cnn', 'socnn']:
+            raise NotImplementedError('streaming inference for ' + specs['kind'] + ' not supported')
+        if (specs['kind'] == 'socnn') and (self.value_cols is None):
+            raise ValueError('value_cols have to be given for SOCNN')
+        self.geometry = [_geometry(chain, self.input_length) for chain in self.chains]
+        self.reset()
+
+    def reset(self):
+        """
+        Drops all observations and cached activations.
+        """
+        self.n = 0
+        self.inputs, self.values = None, None
+        self.states = [{} for chain in self.chains]
+
+    def update(self, row):
+        """
+        Function that appends an observation to the window.
+        Arguments:
+            row         - (numpy.array) observation (preprocessed as the
+                          generator's rows)
+        Returns
+            forecast as returned by predict, or None until input_length
+            observations are available
+        """
+        row = np.asarray(row, dtype=np.float32).ravel()
+        if self.inputs is None:
+            self.inputs = _Window(self.input_length, len(row) if (self.input_cols is None)
+                                                     else len(self.input_cols))
+            if self.value_cols is not None:
+                self.values = _Window(self.input_length, len(self.value_cols))
+        self.inputs.shift(1)
+        self.inputs.view()[-1] = row if (self.input_cols is None) else row[self.input_cols]
+        if self.values is not None:
+            self.values.shift(1)
+            self.values.view()[-1] = row[self.value_cols]
+        self.n += 1
+        if self.n < self.input_length:
+            return None
+        outs = [self._advance(k) for k in range(len(self.chains))]
+        return self._head(outs, None if (self.values is None) else self.values.view())
+
+    def _advance(self, k):
+        chain, (geo, P) = self.chains[k], self.geometry[k]
+        phase = self.n % P
+        fresh = phase not in self.states[k]
+        if fresh:
+            self.states[k][phase] = []
+        bufs = self.states[k][phase]
+        x = self.inputs.view()
+        for j, (st, g) in enumerate(zip(chain, geo)):
+            n, left, right = g['length'], g['left'], g['right']
+            if fresh:
+                dim = st['kernel'].shape[2] if (st['type'] == 'conv') else x.shape[1]
+                bufs.append(_Window(n, dim))
+                pos = np.arange(n)
+            else:
+                bufs[j].shift(g['shift'])
+                pos = np.arange(n) if (left + right >= n) else \
+                      np.r_[np.arange(left), np.arange(n - right, n)]
+            bufs[j].view()[pos] = stage_rows(st, x, pos)
+            x = bufs[j].view()
+        return x
+
+
+def from_model(model):
+    """
+    Returns StreamingPredictor for a trained nnts.models CNNmodel or
+    SOCNNmodel object.
+    """
+    specs = extract_specs(model.nn)
+    value_cols = None
+    if specs['kind'] == 'socnn':
+        value_cols = np.asarray(model.G.get_target_col_ids(cols=model.target_cols))
+    return StreamingPredictor(specs, value_cols=value_cols)
+
+
+def rollout(predictor, x, horizon, value_cols=None):
+    """
+    Function that forecasts 'horizon' steps recursively with a one-step
+    network, for a batch of windows at once, feeding each prediction back as
+    the latest observation.
+    Arguments:
+        predictor   - object with predict method taking a batch of windows,
+                      e.g. Predictor (for SOCNN with value_cols) or a keras
+                      network with a single input
+        x           - (numpy.array) windows of shape (no. of windows,
+                      input_length, row dimension)
+        horizon     - no. of steps to forecast
+        value_cols  - indices of the predicted columns in the rows; if None,
+                      predictor.value_cols
+    Returns
+        numpy.array of shape (no. of windows, horizon, len(value_cols)); the
+        other columns of the fed back rows keep their last observed values
+    """
+    if value_cols is None:
+        value_cols = getattr(predictor, 'value_cols', None)
+    if value_cols is None:
+        raise ValueError('value_cols have to be given')
+    x = np.asarray(x, dtype=np.float32)
+    n, L = x.shape[:2]
+    rows = np.empty((n, L + horizon, x.shape[2]), dtype=np.float32)
+    rows[:, :L] = x
+    out = np.empty((n, horizon, len(value_cols)), dtype=np.float32)
+    for h in range(horizon):
+        y = np.asarray(predictor.predict(rows[:, h: h + L]))
+        out[:, h] = y.reshape(n, -1, len(value_cols))[:, 0]
+        rows[:, L + h] = rows[:, L + h - 1]
+        rows[:, L + h, value_cols] = out[:, h]
+    return out
+
+
+def _pack(obj, arrays, key):
+    """
+    Returns JSON-serializable copy of specs 'obj' with numpy arrays moved to
+    the dictionary 'arrays'.
+    """
+    if isinstance(obj, np.ndarray):
+        arrays[key] = obj
+        return {'__array__': key}
+    if isinstance(obj, dict):
+        return {k: _pack(v, arrays, key + '.' + k) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_pack(v, arrays, key + '.%d' % i) for i, v in enumerate(obj)]
+    return obj
+
+
+def nbytes(specs):
+    """
+    Returns memory (in bytes) held by the arrays of specs, i.e. by the weights
+    of a predictor built on them.
+    """
+    arrays = {}
+    _pack(specs, arrays, 'specs')
+    return int(np.sum([a.nbytes for a in {id(a): a for a in arrays.values()}.values()]))
+
+
+def _unpack(obj, arrays):
+    if isinstance(obj, dict):
+        if '__array__' in obj:
+            return arrays[obj['__array__']]
+        return {k: _unpack(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_unpack(v, arrays) for v in obj]
+    return obj
+
+
+def export(model, path):
+    """
+    Function that saves a trained network as a numpy forward pass.
+    Arguments:
+        model       - nnts.models LRmodel, CNNmodel, SOCNNmodel or LSTMmodel
+                      object, or its keras.models.Model
+        path        - path of the .npz file
+    """
+    specs = extract_specs(getattr(model, 'nn', model))
+    if (specs['kind'] == 'socnn') and hasattr(model, 'G'):
+        specs['value_cols'] = [int(i) for i in model.G.get_target_col_ids(cols=model.target_cols)]
+    save(specs, path)
+
+
+def save(specs, path):
+    """
+    Function that saves specs (e.g. quantized by quantize) to the .npz file
+    'path', to be restored by load.
+    """
+    arrays = {}
+    skeleton = _pack(specs, arrays, 'specs')
+    np.savez(path, specs=np.array(json.dumps(skeleton)), **arrays)
+
+
+def load(path, **kwargs):
+    """
+    Function that restores the network saved by export.
+    Arguments:
+        path        - path of the .npz file
+        kwargs      - passed to the predictor (e.g. input_cols)
+    Returns
+        LSTMSession for LSTM networks, StreamingPredictor for CNN networks
+        and SOCNN networks with known value_cols, else Predictor
+    """
+    with np.load(path) as f:
+        arrays = {k: f[k] for k in f.files}
+    return from_specs(_unpack(json.loads(str(arrays.pop('specs'))), arrays), **kwargs)
+
+
+def from_specs(specs, **kwargs):
+    """
+    Returns the predictor of a network given by specs (see extract_specs):
+    LSTMSession for LSTM networks, StreamingPredictor for CNN networks and
+    SOCNN networks with known value_cols, else Predictor.
+    """
+    if specs['kind'] == 'lstm':
+        return LSTMSession(specs, **kwargs)
+    if (specs['kind'] == 'lr') or ((specs['kind'] == 'socnn') and (kwargs.get('value_cols') is None)
+                                   and (specs.get('value_cols') is None)):
+        return Predictor(specs, **kwargs)
+    return StreamingPredictor(specs, **kwargs)
+
+
+def parity(nn, X):
+    """
+    Function that checks the numpy forward pass against keras.
+    Arguments:
+        nn          - keras.models.Model object of an LRmodel, CNNmodel or
+                      SOCNNmodel
+        X           - batch of network inputs as passed to nn.predict
+    Returns
+        maximal absolute difference between the predictions (of main_output
+        for SOCNN)
+    """
+    y = nn.predict(X)
+    if type(y) == list:
+        y = y[0]
+    x, v = _split_inputs(X)
+    return np.abs(Predictor(extract_specs(nn)).predict(x, value_input=v) - y).max()
+
+
+def _split_inputs(X):
+    """
+    Returns (inp, value_input) from the network inputs X (as passed to
+    nn.predict); value_input is None for single-input networks.
+    """
+    if type(X) == dict:
+        return X['inp'], X['value_input']
+    if type(X) == list:
+        return X[0], X[1]
+    return X, None
+
+
+def _quantize_weights(d, name, mode, axes):
+    """
+    Quantizes d[name] in place; 'axes' - axes reduced when computing the int8
+    scales (all axes but the output channels).
+    """
+    w = np.asarray(d[name], dtype=np.float32)
+    if mode == 'float16':
+        d[name] = w.astype(np.float16)
+    elif mode == 'int8':
+        scale = np.abs(w).max(axis=axes, keepdims=True) / 127.
+        scale[scale == 0] = 1.
+        d[name] = np.round(w / scale).astype(np.int8)
+        d[name + '_scale'] = scale.astype(np.float32)
+    else:
+        raise ValueError('unknown quantization mode ' + repr(mode))
+
+
+def _correct(d, name, x, contract, mode, axes):
+    """
+    Quantizes weights d[name] and, if calibration inputs x are given, adds the
+    mean error of the quantized output (function 'contract' of x and the
+    weights) to the bias (bias correction).
+    """
+    y = None if (x is None) else contract(x, weights(d, name))
+    _quantize_weights(d, name, mode, axes)
+    if y is not None:
+        err = y - contract(x, weights(d, name))
+        d['bias'] = (d['bias'] + err.reshape((-1,) + d['bias'].shape).mean(axis=0)).astype(np.float32)
+
+
+def quantize(specs, mode='int8', calibration=None):
+    """
+    Function that quantizes the weights of LR, CNN or SOCNN specs.
+    Arguments:
+        specs       - dictionary returned by extract_specs (or load(...).specs)
+        mode        - 'int8': int8 weights with a scale per output channel
+                      'float16': float16 weights
+                      (Predictor dequantizes one layer at a time and
+                      computes in float32 in both cases)
+        calibration - network inputs (as passed to nn.predict, e.g. returned by
+                      calibration_windows); if given, the mean output error
+                      of each quantized layer on them is added to its bias
+    Returns
+        quantized copy of specs
+    """
+    if specs['kind'] not in ['lr', 'cnn', 'socnn']:
+        raise NotImplementedError('quantization for ' + specs['kind'] + ' not supported')
+    specs = copy.deepcopy(specs)
+    P = Predictor(specs)
+    x, v = (None, None) if (calibration is None) else P._inputs(*_split_inputs(calibration))
+    full = lambda st, h: stage_rows(st, h, np.arange(_geometry([st], h.shape[-2])[0][0]['length']))
+    outs = []
+    for chain in _chains(specs):
+        h = x
+        for st in chain:
+            if st['type'] == 'conv':
+                _correct(st, 'kernel', h, lambda h, w: full(dict(st, kernel=w, bias=0., acts=[]), h),
+                         mode, axes=(0, 1))
+            if h is not None:
+                h = full(st, h)
+        outs.append(h)
+    if specs['kind'] in ['lr', 'cnn']:
+        _correct(specs['dense'], 'kernel', None if (x is None) else _flat(outs[0]),
+                 lambda h, w: h.dot(w), mode, axes=(0,))
+    else:
+        main = None if (x is None) else _main(specs, outs, v)
+        _correct(specs['out'], 'kernel', main,
+                 lambda h, w: np.einsum('...sc,scf->...sf', h, w), mode, axes=(1,))
+    return specs
+
+
+def calibration_windows(model, n=256, mode='valid'):
+    """
+    Returns the network inputs of the first n samples of the validation
+    ('valid') or test share of an nnts.models Model object's generator.
+    """
+    G = model.G
+    offsets = getattr(model.io_func, 'offsets', None)
+    x = G._get_batch(G.indices(mode)[:n], offsets=offsets)
+    return (model.io_func(x) if (offsets is None) else model.io_func(x, gathered=True))[0]
+
+
+def quantization_report(specs, X, calibration=None, modes=('float16', 'int8'), tolerance=.01,
+                        repeat=3, verbose=1):
+    """
+    Function that compares quantized networks with the float one.
+    Arguments:
+        specs       - dictionary returned by extract_specs (float weights)
+        X           - network inputs to evaluate on (as passed to nn.predict)
+        calibration - inputs passed to quantize
+        modes       - quantization modes to compare
+        tolerance   - maximal relative error (RMSE of the difference from the
+                      float predictions divided by their standard deviation)
+                      of a network safe to deploy
+        repeat      - no. of timed prediction passes over X
+    Returns
+        dictionary mode -> dictionary with the memory held by the weights
+        ('bytes', see nbytes),
+        'max_error', 'rmse', 'relative_error', 'throughput' (samples per second)
+        and 'safe' (relative_error <= tolerance); mode 'float32' - the float
+        network
+    """
+    x, v = _split_inputs(X)
+    report = {}
+    for mode in ('float32',) + tuple(modes):
+        P = Predictor(specs if (mode == 'float32') else quantize(specs, mode, calibration))
+        t0 = time.time()
+        for r in range(repeat):
+            y = P.predict(x, value_input=v)
+        t = (time.time() - t0) / repeat
+        if mode == 'float32':
+            y0 = y
+        rmse = np.sqrt(np.mean((y - y0)**2))
+        report[mode] = {'bytes': nbytes(P.specs),
+                        'max_error': float(np.abs(y - y0).max()), 'rmse': float(rmse),
+                        'relative_error': float(rmse / max(y0.std(), 1e-12)),
+                        'throughput': len(y) / t}
+        report[mode]['safe'] = report[mode]['relative_error'] <= tolerance
+        if verbose > 0:
+            print('%s: time = %.2fs, bytes = %d, relative error = %.5f, max error = %.5f, throughput = %.1f/s%s' %
+                  (mode, t, report[mode]['bytes'], report[mode]['relative_error'],
+                   report[mode]['max_error'], report[mode]['throughput'],
+                   '' if report[mode]['safe'] else ' (not safe)'))
+    return report
+
+
+class LSTMSession(object):
+    """
+    Class that keeps the states of a stateful LSTMmodel network for many
+    series and predicts the next value of each series after each of its
+    observations, at the cost of one recurrent step.
+    Initialization arguments:
+        specs       - dictionary returned by extract_specs for an LSTMmodel
+                      network
+        input_cols  - indices of the columns of the observed rows fed to the
+                      network (None - all)
+        capacity    - initial no. of series in the state store (grows as
+                      needed)
+    """
+    def __init__(self, specs, input_cols=None, capacity=64):
+        if specs['kind'] != 'lstm':
+            raise ValueError('LSTMSession requires specs of an LSTM network')
+        self.specs = specs
+        self.input_cols = input_cols
+        self.units = specs['lstm']['recurrent_kernel'].shape[0]
+        self.slots = {}     # series id -> row of self.h and self.c
+        self.ids = []       # series id of each used row
+        self.h = np.zeros((capacity, self.units), dtype=np.float32)
+        self.c = np.zeros((capacity, self.units), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _rows(self, ids):
+        """
+        Returns rows of the state store for series 'ids', adding new series
+        with zero states.
+        """
+        new = [i for i in ids if i not in self.slots]
+        if len(self.ids) + len(new) > len(self.h):
+            capacity = max(2 * len(self.h), len(self.ids) + len(new))
+            for name in ['h', 'c']:
+                arr = np.zeros((capacity, self.units), dtype=np.float32)
+                arr[:len(self.ids)] = getattr(self, name)[:len(self.ids)]
+                setattr(self, name, arr)
+        for i in new:
+            self.slots[i] = len(self.ids)
+            self.ids.append(i)
+        return np.array([self.slots[i] for i in ids], dtype=int)
+
+    def step(self, ids, X):
+        """
+        Function that feeds one observation of each of the given series.
+        Arguments:
+            ids         - list of (distinct) series ids
+            X           - numpy.array of shape (len(ids), row dimension) with
+                          the observations (preprocessed as the generator's
+                          rows)
+        Returns
+            numpy.array of shape (len(ids), odim) with the predictions of the
+            next observation
+        """
+        if len(set(ids)) != len(ids):
+            raise ValueError('series ids in one step have to be distinct')
+        rows = self._rows(ids)
+        X = np.asarray(X, dtype=np.float32).reshape(len(ids), -1)
+        y, self.h[rows], self.c[rows] = self._cell(X, self.h[rows], self.c[rows])
+        return y
+
+    def _cell(self, X, h, c):
+        """
+        Returns predictions and the new states h, c after observations X.
+        """
+        lstm = self.specs['lstm']
+        if self.input_cols is not None:
+            X = X[:, self.input_cols]
+        z = X.dot(lstm['kernel']) + h.dot(lstm['recurrent_kernel']) + lstm['bias']
+        i, f, g, o = np.split(z, 4, axis=1)
+        ract = [lstm['recurrent_activation'], 0.]
+        act = [lstm['activation'], 0.]
+        c = activate(f, ract) * c + activate(i, ract) * activate(g, act)
+        h = activate(o, ract) * activate(c, act)
+        y = h
+        for a in self.specs['acts']:
+            y = activate(y, a)
+        y = y.dot(self.specs['dense']['kernel']) + self.specs['dense']['bias']
+        for a in self.specs['dense']['acts']:
+            y = activate(y, a)
+        return y, h, c
+
+    def predict(self, x):
+        """
+        Function that runs whole input windows from zero states, without
+        touching the stored series (the stateless interface of Predictor,
+        used e.g. by nnts.serving.ForecastService).
+        Arguments:
+            x           - numpy.array of shape (batch, timesteps, row
+                          dimension)
+        Returns
+            numpy.array of shape (batch, timesteps, odim) with the prediction
+            after each timestep
+        """
+        x = np.asarray(x, dtype=np.float32)
+        h = np.zeros((len(x), self.units), dtype=np.float32)
+        c = np.zeros_like(h)
+        ys = []
+        for t in range(x.shape[1]):
+            y, h, c = self._cell(x[:, t], h, c)
+            ys.append(y)
+        return np.stack(ys, axis=1)
+
+    def reset(self, ids=None):
+        """
+        Sets the states of series 'ids' (None - all) to zero.
+        """
+        rows = slice(None) if (ids is None) else \
+               np.array([self.slots[i] for i in ids if i in self.slots], dtype=int)
+        self.h[rows] = 0
+        self.c[rows] = 0
+
+    def drop(self, ids):
+        """
+        Removes series 'ids' from the state store.
+        """
+        for i in ids:
+            if i not in self.slots:
+                continue
+            row, last = self.slots.pop(i), len(self.ids) - 1
+            if row != last:
+                self.h[row], self.c[row] = self.h[last], self.c[last]
+                self.ids[row] = self.ids[last]
+                self.slots[self.ids[row]] = row
+            self.ids.pop()
+            self.h[last] = 0
+            self.c[last] = 0
+
+    def snapshot(self, ids=None):
+        """
+        Returns a copy of the states of series 'ids' (None - all) as
+        a dictionary with keys 'ids', 'h' and 'c'.
+        """
+        ids = list(self.ids) if (ids is None) else list(ids)
+        rows = np.array([self.slots[i] for i in ids], dtype=int)
+        return {'ids': ids, 'h': self.h[rows].copy(), 'c': self.c[rows].copy()}
+
+    def restore(self, snapshot):
+        """
+        Sets the states of the series in 'snapshot' (as returned by
+        self.snapshot), adding series not yet in the store.
+        """
+        rows = self._rows(snapshot['ids'])
+        self.h[rows] = snapshot['h']
+        self.c[rows] = snapshot['c']
@@ -380,15 +380,43 @@ class TensorBoard(keras.callbacks.TensorBoard):
         else:
             self.writer = tf.summary.FileWriter(self.log_dir)
             
+class Validate(keras.callbacks.Callback):
+    """
+    Callback that evaluates the model on fixed validation data at the end of
+    each epoch and stores the results in logs as 'val_<metric name>', so that
+    the callbacks placed after it (e.g. LrReducer) can monitor them.
+    """
+    def __init__(self, X, y, batch_size=1024, verbose=1):
+        super(Validate, self).__init__()
+        self.X, self.y = X, y
+        self.batch_size = batch_size
+        self.verbose = verbose
+        
+    def on_epoch_end(self, epoch, logs={}):
+        ev = self.model.evaluate(self.X, self.y, batch_size=self.batch_size, 
+                                 verbose=0)
+        if not hasattr(ev, '__iter__'):
+            ev = [ev]
+        val_loss = '\n--'
+        for loss, value in zip(self.model.metrics_names, ev):
+            logs['val_' + loss] = value
+            val_loss += '- val_%s: %f ' % (loss, value)
+        if self.verbose > 0:
+            print(val_loss)
+        
+            
 class Test(keras.callbacks.Callback):
-    def __init__(self, G, io_func, verbose):
+    def __init__(self, G, io_func, verbose, windows=None, batch_size=None):
         super(keras.callbacks.Callback, self).__init__()
         self.verbose = verbose
-        self.batch_size = G.batch_size
-        test_gen = G.gen(mode='test',
-                         batch_size=G.n_test - G.n_valid - G.l,
-                         func=io_func)
-        self.X, self.y = next(test_gen)
+        self.batch_size = G.batch_size if (batch_size is None) else batch_size
+        if windows is None:
+            test_gen = G.gen(mode='test',
+                             batch_size=G.n_test - G.n_valid - G.l,
+                             func=io_func)
+            self.X, self.y = next(test_gen)
+        else:
+            self.X, self.y = io_func(windows)
         self.test_hist = {}
         self.time0 = time.time()
         
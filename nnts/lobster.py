@@ -6,15 +6,288 @@ Created on Tue Jun  6 18:58:19 2017
 """
 
 from ._imports_ import *
+from . import utils, shared
+import multiprocessing
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from .config import WDIR
 
+MESSAGE_COLUMNS = ['Time', 'Type', 'ID', 'Size', 'Price', 'Direction']
+OPEN_TIME, CLOSE_TIME = 9.5*60*60, 16*60*60   # trading hours in seconds after midnight
+
+def book_columns(file_lvl):
+    names = []
+    for i in np.arange(1, file_lvl + 1):
+        names += ['AskP %i' % i, 'AskV %i' % i, 'BidP %i' % i, 'BidV %i' % i]
+    return names
+    
+def future_indices(times, horizons):
+    """
+    Function that finds, for every event, the last event that happens no 
+    later than the given time horizon after it.
+    Arguments:
+        times       - (numpy.array) sorted event times
+        horizons    - list of time horizons
+    Returns
+        numpy.array of shape (len(horizons), len(times)) and dtype int32
+    """
+    return np.array([np.searchsorted(times, times + h, side='right') - 1 
+                     for h in horizons], dtype=np.int32)
+    
+
+def book_grids(askP, askV, bidP, bidV, price, size, Pmin, Pmax, tick=100):
+    """
+    Function that scatters the book levels and the messages of a chunk of 
+    events into dense volume grids with one column per price tick.
+    Arguments:
+        askP, askV, bidP, bidV  - (numpy.array) of shape (events, levels) with
+                                  prices and volumes of the book levels
+        price, size             - (numpy.array) message prices and signed sizes
+        Pmin, Pmax              - price range of the grids; messages outside
+                                  of the range are discarded
+        tick                    - price tick
+    Returns
+        tuple of numpy.arrays of shape (events, (Pmax - Pmin)//tick + 1): 
+        book volumes (negative for bids) and message sizes
+    """
+    n, lvls = askP.shape
+    rows = np.repeat(np.arange(n), lvls)
+    V = np.zeros((n, (Pmax - Pmin)//tick + 1))
+    np.add.at(V, (rows, ((bidP - Pmin)//tick).ravel()), -np.nan_to_num(bidV).ravel())
+    np.add.at(V, (rows, ((askP - Pmin)//tick).ravel()), np.nan_to_num(askV).ravel())
+    M = np.zeros_like(V)
+    ok = (price >= Pmin) & (price <= Pmax) & ((price - Pmin) % tick == 0)
+    M[np.arange(len(price))[ok], (price[ok] - Pmin)//tick] = size[ok]
+    return V, M
+    
+
+EVENT_KEYS = ['Time', 'Type', 'Price', 'Size', 'Pmid', 'band']
+EVENT_DTYPES = [np.float64, np.uint8, np.int64, np.float32, np.int64, np.float32]
+
+def event_arrays(mess, levels, Pmid, keep_lvl, tick=100, margin=0):
+    """
+    Function that converts messages and book levels into the compact 
+    representation, which stores only the 2*(keep_lvl + margin) ticks around 
+    the mid price of each event.
+    Arguments:
+        mess        - (pandas.DataFrame) messages with normalized signed 'Size'
+        levels      - list of numpy.arrays of shape (events, levels) with 
+                      AskP, AskV, BidP and BidV columns
+        Pmid        - (numpy.array) mid price of each event
+        keep_lvl    - no. of ticks kept on each side of the mid price
+        tick        - price tick
+        margin      - no. of extra ticks stored on each side, so that future
+                      book states can be shifted to the current mid price
+                      (see max_shift)
+    Returns
+        dictionary of numpy.arrays: 'Time', 'Type' (uint8), 'Price', 'Size' 
+        (float32), 'Pmid' and 'band' (float32, events x 2*(keep_lvl + margin)
+        book volumes, negative for bids)
+    """
+    askP, askV, bidP, bidV = levels
+    n, lvls = askP.shape
+    k = keep_lvl + margin
+    band = np.zeros((n, 2*k), dtype=np.float32)
+    rows = np.repeat(np.arange(n), lvls)
+    for P, V, sign in [(bidP, bidV, -1), (askP, askV, 1)]:
+        cols = (P - (Pmid - k*tick)[:, None]).ravel()
+        ok = (cols >= 0) & (cols < 2*k*tick) & (cols % tick == 0)
+        np.add.at(band, (rows[ok], cols[ok]//tick), sign * np.nan_to_num(V.ravel()[ok]))
+    return {'Time': np.array(mess['Time']),
+            'Type': np.asarray(mess['Type'], dtype=np.uint8),
+            'Price': np.array(mess['Price']),
+            'Size': np.asarray(mess['Size'], dtype=np.float32),
+            'Pmid': Pmid,
+            'band': band}
+
+
+def max_shift(Pmid, futures, end, tick=100, block=1000000):
+    """
+    Returns the maximal no. of ticks the mid price moves between events 0 to
+    'end' (inclusive) and their future events 'futures' (array of shape 
+    (horizons, events)), i.e. the margin event_arrays needs for lossless 
+    future book states.
+    """
+    shift = 0
+    for a in range(0, end + 1, block):
+        b = min(a + block, end + 1)
+        P = np.asarray(Pmid[a: b])
+        shift = max(shift, int(np.abs(Pmid[np.asarray(futures[:, a: b])] - P).max()) // tick)
+    return shift
+    
+
+_store_ids = itertools.count()
+_stores = weakref.WeakSet()
+
+def _after_fork():
+    # forked processes inherit the stores without unpickling them; they take
+    # their own references at once and drop the parent's prefetch thread
+    for store in list(_stores):
+        store._init_cache(store.cache)
+        store._hold()
+        
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+    
+def _release_store(directory, ref, pid):
+    # finalizers are copied to forked processes; only the holder releases
+    if os.getpid() == pid:
+        shared.release_directory(directory, ref)
+
+class ChunkStore(object):
+    """
+    List-like store of numpy arrays (chunks) that keeps only the 
+    'cache_chunks' most recently used chunks in memory; all chunks are 
+    written to .npy files on append and read back on a cache miss. After 
+    every access the following chunk is read in a background thread.
+    Initialization arguments:
+        directory   - directory for the chunk files; if None, a temporary 
+                      directory is created. Every process using the store 
+                      holds a reference file in it (as in nnts.shared) and 
+                      the directory is removed when the last of them drops 
+                      its store
+        cache_chunks - no. of chunks kept in memory
+        prefetch    - if True, the chunk following the accessed one is read
+                      ahead
+    """
+    def __init__(self, directory=None, cache_chunks=4, prefetch=True):
+        self.owned = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='nnts_chunks_')
+        elif not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.pid = None
+        self._hold()
+        _stores.add(self)
+        self.cache_chunks = cache_chunks
+        self.prefetch = prefetch
+        self.n = 0
+        self.hits, self.misses = 0, 0
+        self._init_cache()
+        
+    def _init_cache(self, cache=None):
+        self.cache = OrderedDict() if (cache is None) else cache
+        self.pending = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1) if self.prefetch else None
+        
+    def _hold(self):
+        """
+        Registers the current process as a user of a temporary directory; the 
+        reference is dropped when the store is collected in this process.
+        """
+        if self.owned and (self.pid != os.getpid()):
+            self.pid = os.getpid()
+            ref = shared.ref_name(next(_store_ids))
+            shared.hold_directory(self.directory, ref)
+            weakref.finalize(self, _release_store, self.directory, ref, self.pid)
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['cache', 'pending', 'lock', 'executor']:
+            del state[key]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pid = None
+        self._init_cache()
+        self._hold()
+        _stores.add(self)
+        
+    def _path(self, k):
+        return os.path.join(self.directory, 'chunk%05d.npy' % k)
+    
+    def _cache(self, k, chunk):
+        self.cache[k] = chunk
+        self.cache.move_to_end(k)
+        while len(self.cache) > self.cache_chunks:
+            self.cache.popitem(last=False)
+        
+    def __len__(self):
+        return self.n
+    
+    def append(self, chunk):
+        np.save(self._path(self.n), chunk)
+        with self.lock:
+            self._cache(self.n, chunk)
+        self.n += 1
+        
+    def __getitem__(self, k):
+        if k < 0:
+            k += self.n
+        if not (0 <= k < self.n):
+            raise IndexError('chunk index %d out of range' % k)
+        with self.lock:
+            if k in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(k)
+            else:
+                self.misses += 1
+                chunk = None
+                if (self.pending is not None) and (self.pending[0] == k):
+                    try:
+                        chunk = self.pending[1].result()
+                    except (OSError, ValueError):
+                        # read ahead failed (e.g. the file was replaced); reload
+                        chunk = None
+                if chunk is None:
+                    try:
+                        chunk = np.load(self._path(k))
+                    except FileNotFoundError:
+                        raise IOError('chunk file %s was removed while the store is in use' 
+                                      % self._path(k))
+                self._cache(k, chunk)
+            if self.prefetch and (k + 1 < self.n) and (k + 1 not in self.cache) \
+                    and ((self.pending is None) or (self.pending[0] != k + 1)):
+                self.pending = (k + 1, self.executor.submit(np.load, self._path(k + 1)))
+            return self.cache[k]
+    
+    
 class LOBSTERGenerator(utils.Generator):
+    """
+    Class that provides sample generator for LOBSTER limit order book data.
+    Each sample consists of input_length - 1 messages, the current book state
+    and the future book state for each time horizon in '_time'.
+    Initialization arguments:
+        filename    - directory with message.csv and orderbook.csv files; 
+                      should end with '_<number of levels>'
+        keep_lvl    - no. of price ticks on each side of the mid price kept 
+                      in the samples
+        _time       - time horizon (in seconds) of the predicted book state,
+                      or list of such horizons
+        chunk       - no. of events per volume grid chunk
+        cache_chunks - if not None, the volume grid chunks are spilled to disk
+                      and only that many of them (per grid) are kept in 
+                      memory (see ChunkStore)
+        chunk_dir   - directory (relative to WDIR) for the spilled chunks; 
+                      if None, a temporary directory is used
+        compact     - if True, instead of the volume grids only the 
+                      ticks around each event's mid price are stored (see 
+                      event_arrays): keep_lvl plus the largest mid price move
+                      over the horizons on each side, so the samples equal 
+                      those of the grids
+        shards      - directory (relative to WDIR) with samples written by 
+                      the materialize method; if it exists, samples are read 
+                      from there and the csv files are not loaded (the shards
+                      must come from the same filename, compact mode, limit 
+                      and sample parameters, otherwise ValueError is raised)
+    """
     def __init__(self, filename, keep_lvl=10, _time=.01,
                  train_share=(.8, 1), input_length=100, output_length=1, 
                  verbose=1, limit=np.inf, batch_size=16, diffs=True,
-                 chunk=10000, **kwargs):
+                 chunk=10000, compact=False, shards=None, cache_chunks=None,
+                 chunk_dir=None, **kwargs):
+        self.source = os.path.normpath(filename)
         self.keep_lvl = keep_lvl
+        self.compact = compact
+        self.lossless = True
         self.time = _time
+        self.times = np.atleast_1d(_time)
         
         self.nameBook = os.path.join(WDIR, filename, 'orderbook.csv')
         self.nameMess = os.path.join(WDIR, filename, 'message.csv')       
@@ -31,27 +304,22 @@ class LOBSTERGenerator(utils.Generator):
         self.diffs = diffs
         self.chunk = chunk
         self.tt = time.time()
+        self.shards = None
+        if (shards is not None) and os.path.isfile(os.path.join(WDIR, shards, 'index.pkl')):
+            self._load_shards(shards)
+            return
         
-        self.mess = pd.read_csv(self.nameMess, names=['Time', 'Type', 'ID', 'Size', 'Price', 'Direction'])
-        start = 9.5*60*60
-        end = 16*60*60
-        timeIdx = (self.mess['Time'] >= start) & (self.mess['Time'] <= end)
-        self.mess = self.mess[timeIdx]
-
-        self.max_end = (self.mess['Time'] <= self.mess['Time'][self.mess.index[-1]] - .01).sum() - 1
+        self.mess = pd.read_csv(self.nameMess, names=MESSAGE_COLUMNS)
+        timeIdx = (self.mess['Time'] >= OPEN_TIME) & (self.mess['Time'] <= CLOSE_TIME)
+        # messages and book rows are aligned by position after filtering
+        self.mess = self.mess[timeIdx].reset_index(drop=True)
 
-        self.n_train = int((self.max_end * train_share[0] - self.l)/batch_size) * batch_size + self.l
-        self.n_valid = self.n_train + int((self.max_end * train_share[1] - self.n_train - self.l)/batch_size) * batch_size + self.l
-        if len(train_share) > 2:
-            self.n_test = self.n_valid + int((self.max_end * train_share[2] - self.n_valid - self.l)/batch_size) * batch_size + self.l
-            self.test = True
-        else:
-            self.test = False
+        self.max_end = (self.mess['Time'] <= self.mess['Time'][self.mess.index[-1]] - self.times.max()).sum() - 1
+        self.futures = future_indices(np.array(self.mess['Time']), self.times)
+        self._set_limits(self.max_end)
         
-        bookNames = []
-        for i in np.arange(1, self.file_lvl + 1):
-            bookNames += ['AskP %i' % i, 'AskV %i' % i, 'BidP %i' % i, 'BidV %i' % i]
-        self.book = pd.read_csv(self.nameBook, names=bookNames)
+        self.book = pd.read_csv(self.nameBook, names=book_columns(self.file_lvl))
+        self.book = self.book[np.array(timeIdx)].reset_index(drop=True)
         
         Vcols = [c for c in self.book.columns if 'V' in c]
         self.Bmean = self.book.loc[:self.n_valid, Vcols].mean().mean()
@@ -63,28 +331,44 @@ class LOBSTERGenerator(utils.Generator):
         self.mess['Size'] = (self.mess['Size'] - self.Mmean) / (self.Mstd + 1e-6*(self.Mstd == 0))
     
         
-        self.Bchunks, self.Mchunks = [], []
         self.mess['Size'] = self.mess['Size'] * self.mess['Direction']
         for jj in range(1, 6):
             self.mess['Type%d' % jj] = (self.mess['Type'] == jj)
+        self.Pmid = ((self.book['AskP 1'] + self.book['BidP 1'])//200 + 1) * 100  
+        
+        lvls = np.arange(1, self.file_lvl + 1)
+        levels = [np.array(self.book[['%s %d' % (c, lvl) for lvl in lvls]]) 
+                  for c in ['AskP', 'AskV', 'BidP', 'BidV']]
+        Pmid = np.array(self.Pmid)
+        if compact:
+            # the band covers the largest mid price move over the horizons
+            self.events = event_arrays(self.mess, levels, Pmid, keep_lvl, 
+                                       margin=max_shift(Pmid, self.futures, self.max_end))
+            return
+        price, size = np.array(self.mess['Price']), np.array(self.mess['Size'])
+        if cache_chunks is None:
+            self.Bchunks, self.Mchunks = [], []
+        else:
+            dirs = [None, None] if (chunk_dir is None) else \
+                   [os.path.join(WDIR, chunk_dir, d) for d in ['B', 'M']]
+            self.Bchunks = ChunkStore(dirs[0], cache_chunks=cache_chunks)
+            self.Mchunks = ChunkStore(dirs[1], cache_chunks=cache_chunks)
+            # defaults for gen(shuffle='block'): a block per chunk and as many
+            # blocks at once as leaves room for the chunks of future states
+            self.block_size = chunk
+            self.block_window = max(1, cache_chunks // 2)
+        self.Pmins = []
         for k in range(int(np.ceil(float(self.book.shape[0])/chunk))):
-            book0 = self.book.loc[k*chunk: (k+1) * chunk - 1]
-            Prange = np.arange(book0['BidP %d' % self.file_lvl].min(), book0['AskP %d' % self.file_lvl].max() + 1, 100)
-            chunk_len = min(chunk, self.book.shape[0] - k*chunk)
-            Vchunk = pd.DataFrame(np.zeros((chunk_len, len(Prange))), columns=Prange, 
-                                  index=np.arange(k*chunk, k*chunk + chunk_len))
-            Mchunk = pd.DataFrame(np.zeros((chunk_len, len(Prange))), columns=Prange, 
-                                  index=np.arange(k*chunk, k*chunk + chunk_len))
-            for lvl in np.arange(1, self.file_lvl + 1):
-                Vbid = book0.pivot(columns='BidP %d' % lvl, values='BidV %d' % lvl).fillna(0.0)
-                Vchunk[Vbid.columns] -= Vbid
-                Vask = book0.pivot(columns='AskP %d' % lvl, values='AskV %d' % lvl).fillna(0.0)
-                Vchunk[Vask.columns] += Vask
-            MV = self.mess.loc[k*chunk: (k+1) * chunk - 1].pivot(values='Size', columns='Price').fillna(.0)
-            Mchunk[MV.columns] = MV
+            rows = slice(k*chunk, (k+1) * chunk)
+            # price range of the chunk's book extended by the band kept around Pmid
+            Pmin = min(levels[2][rows, -1].min(), Pmid[rows].min() - self.keep_lvl*100)
+            Pmax = max(levels[0][rows, -1].max(), Pmid[rows].max() + self.keep_lvl*100)
+            Vchunk, Mchunk = book_grids(*[lvl[rows] for lvl in levels], 
+                                        price=price[rows], size=size[rows], 
+                                        Pmin=Pmin, Pmax=Pmax)
             self.Bchunks.append(Vchunk)
             self.Mchunks.append(Mchunk)
-        self.Pmid = ((self.book['AskP 1'] + self.book['BidP 1'])//200 + 1) * 100  
+            self.Pmins.append(Pmin)
         
             
     def get_target_col_ids(self, cols, ids=True):
@@ -100,20 +384,142 @@ class LOBSTERGenerator(utils.Generator):
     def get_dims(self, cols):
         return self.get_dim(), len(self.get_target_col_ids(cols=cols))
             
+    def _event_sample(self, events, futures, i, return_xy=False):
+        """
+        Function that builds the i-th sample from the compact representation.
+        Book states of the future events are shifted to the mid price of the 
+        i-th event; ticks outside of their stored band (possible only if the
+        mid price moves more than the band's margin, see self.lossless) are 
+        set to 0.
+        Arguments:
+            events      - dictionary returned by event_arrays
+            futures     - indices of the future events, one per time horizon
+            i           - index of the current event
+        """
+        k, r = self.keep_lvl, np.arange(i - self.input_length + 2, i + 1)
+        width = events['band'].shape[1]
+        m = width // 2 - k
+        state = np.zeros((1, 6 + 2*k), dtype=np.float32)
+        state[0, 6:] = events['band'][i][m: m + 2*k]
+        future_state = np.zeros((len(futures), 6 + 2*k), dtype=np.float32)
+        shifts = (events['Pmid'][futures] - events['Pmid'][i]) // 100
+        for row, f, shift in zip(future_state, futures, shifts):
+            # tick j of the current band is tick j - shift + m of the future one
+            lo, hi = max(0, shift - m), min(2*k, width + shift - m)
+            if lo < hi:
+                row[6 + lo: 6 + hi] = events['band'][f][lo - shift + m: hi - shift + m]
+        Messages = np.zeros((len(r), 6 + 2*k), dtype=np.float32)
+        Messages[:, 0] = events['Time'][r] - events['Time'][i]
+        Messages[:, 1:6] = (events['Type'][r, None] == np.arange(1, 6))
+        cols = events['Price'][r] - events['Pmid'][i] + k*100
+        ok = (cols >= 0) & (cols < 2*k*100) & (cols % 100 == 0)
+        Messages[ok, 6 + cols[ok]//100] = events['Size'][r][ok]
+        
+        if self.diffs:
+            future_state -= state
+        if return_xy:
+            return np.r_[Messages, state], future_state
+        return np.r_[Messages, state, future_state]
+        
+    def _grid_rows(self, grids, rows, iP):
+        """
+        Function that reads the chunked volume grids at given rows and prices.
+        Arguments:
+            grids       - self.Bchunks or self.Mchunks
+            rows        - (numpy.array) of event indices
+            iP          - (numpy.array) of prices
+        Returns
+            numpy.array of shape (len(rows), len(iP)), zero at the prices 
+            outside of the chunk's grid
+        """
+        rows = np.asarray(rows)
+        out = np.zeros((len(rows), len(iP)))
+        for k in np.unique(rows // self.chunk):
+            sel = (rows // self.chunk == k)
+            grid = grids[k]
+            cols = (iP - self.Pmins[k]) // 100
+            ok = (cols >= 0) & (cols < grid.shape[1])
+            out[np.ix_(sel, ok)] = grid[rows[sel] - k*self.chunk][:, cols[ok]]
+        return out
+            
+    def materialize(self, directory, shard_size=4096, processes=None):
+        """
+        Function that builds the samples for all indices of the training, 
+        validation and test shares, splitting the index range across a pool
+        of processes, and writes them as float32 .npy shards. Generators 
+        constructed with shards=directory read the samples from these files.
+        Arguments:
+            directory   - output directory (relative to WDIR)
+            shard_size  - no. of samples per shard
+            processes   - no. of worker processes (None - no. of CPUs)
+        """
+        path = os.path.join(WDIR, directory)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        start = self.indices('train')[0]
+        stop = self.indices('test' if self.test else 'valid')[-1] + 1
+        tasks = [(path, k, a, min(a + shard_size, stop)) 
+                 for k, a in enumerate(range(start, stop, shard_size))]
+        pool = multiprocessing.Pool(processes, initializer=_init_shard_worker, 
+                                    initargs=(self,))
+        pool.map(_write_shard, tasks)
+        pool.close()
+        pool.join()
+        index = dict([(k, getattr(self, k, None)) for k in SHARD_KEYS])
+        index.update({'times': list(self.times), 'shard_start': start, 
+                      'shard_size': shard_size, 'shards': len(tasks)})
+        pd.to_pickle(index, os.path.join(path, 'index.pkl'))
+        
+    def _load_shards(self, directory):
+        index = pd.read_pickle(os.path.join(WDIR, directory, 'index.pkl'))
+        params = dict([(k, getattr(self, k)) for k in SHARD_PARAMS])
+        params['times'] = list(self.times)
+        for key, value in params.items():
+            if index.get(key) != value:
+                raise ValueError('%s = %s does not match the value %s used for shards in %s' 
+                                 % (key, repr(value), repr(index.get(key)), directory))
+        self.__dict__.update(index)
+        self.shards = [np.load(os.path.join(WDIR, directory, 'shard%05d.npy' % k), mmap_mode='r') 
+                       for k in range(index['shards'])]
+        if self.verbose > 0:
+            print('%d samples in %d shards read from %s' 
+                  % (sum(len(x) for x in self.shards), len(self.shards), directory))
+            
+    def _shard_sample(self, i, return_xy=False):
+        x = self._get_batch(np.array([i]))[0]
+        if return_xy:
+            return x[:-len(self.times)], x[-len(self.times):]
+        return x
+        
+    def _get_batch(self, idx, offsets=None, out=None):
+        if self.shards is None:
+            return super(LOBSTERGenerator, self)._get_batch(idx, offsets=offsets, out=out)
+        k, j = np.divmod(idx - self.shard_start, self.shard_size)
+        shape = (len(idx),) + self.shards[0].shape[1:]
+        if offsets is not None:
+            shape = shape[:1] + (len(offsets),) + shape[2:]
+        x = np.empty(shape, dtype=np.float32) if (out is None) else out
+        for s in np.unique(k):
+            rows = self.shards[s][j[k == s]]
+            x[k == s] = rows if (offsets is None) else rows[:, offsets]
+        return x
+            
     def _get_ith_sample(self, i, return_xy=False):
         assert self.input_length <= i, 'n=%d too large for i=%d' % (self.input_length, i)
-        future = i - 1 + (self.mess['Time'][i:] <= self.mess['Time'][i] + self.time).sum()
+        if self.shards is not None:
+            return self._shard_sample(i, return_xy=return_xy)
+        if self.compact:
+            return self._event_sample(self.events, self.futures[:, i], i, 
+                                      return_xy=return_xy)
         iP = np.arange(self.Pmid[i] - self.keep_lvl*100, self.Pmid[i] + self.keep_lvl*100, 100)
-        state = np.c_[np.zeros((1, 6)),
-                      [np.array(self.Bchunks[i//self.chunk].loc[i, iP])]]
-        future_state = np.c_[np.zeros((1, 6)),
-                             [np.array(self.Bchunks[future//self.chunk].loc[future, iP])]]
-        i_max = i//self.chunk
-        i_min = (i - self.input_length + 2)//self.chunk
-        i_chunks = [chunk.loc[i - self.input_length + 2: i, iP] for chunk in self.Mchunks[i_min: i_max + 1]]
+        state = np.c_[np.zeros((1, 6)), 
+                      self._grid_rows(self.Bchunks, [i], iP)]
+        future_state = np.c_[np.zeros((len(self.times), 6)),
+                             self._grid_rows(self.Bchunks, self.futures[:, i], iP)]
         i_Types = self.mess.loc[i - self.input_length + 2: i, ['Time'] + ['Type%d' % jj for jj in range(1, 6)]]
         i_Types['Time'] -= i_Types.loc[i, 'Time']
-        Messages = np.c_[np.array(i_Types), np.array(pd.concat(i_chunks))]
+        Messages = np.c_[np.array(i_Types), 
+                         self._grid_rows(self.Mchunks, np.arange(i - self.input_length + 2, i + 1), iP)]
         
         if self.diffs:
             future_state -= state
@@ -123,6 +529,225 @@ class LOBSTERGenerator(utils.Generator):
         
     
         
+
+
+class LOBSTERDaysGenerator(LOBSTERGenerator):
+    """
+    Class that provides sample generator for many trading days of LOBSTER 
+    data preprocessed with the ingest function. The per-day event arrays are 
+    memory-mapped, so only the sampled windows are read into RAM. Samples 
+    never cross day boundaries; training, validation and test shares are 
+    consecutive ranges of all valid sample positions.
+    Initialization arguments:
+        filename    - output directory of ingest (relative to WDIR)
+        _time       - time horizon (in seconds) of the predicted book state,
+                      or list of such horizons
+        shards      - directory with materialized samples, as for 
+                      LOBSTERGenerator
+    The book bands are stored with the margin given to ingest; if the mid 
+    price moves more than that within a horizon, the ticks of the future book
+    states beyond the band are set to 0 and self.lossless is False.
+    """
+    def __init__(self, filename, _time=.01, train_share=(.8, 1), 
+                 input_length=100, output_length=1, verbose=1, limit=np.inf, 
+                 batch_size=16, diffs=True, shards=None, **kwargs):
+        index = pd.read_pickle(os.path.join(WDIR, filename, 'index.pkl'))
+        self.__dict__.update(index['stats'])
+        self.keep_lvl = index['keep_lvl']
+        self.file_lvl = index['file_lvl']
+        self.source = os.path.normpath(filename)
+        self.compact = True
+        self.time = _time
+        self.times = np.atleast_1d(_time)
+        self.train_share = train_share
+        self.input_length = input_length
+        self.output_length = output_length
+        self.l = input_length + output_length
+        self.verbose = verbose
+        self.limit = limit
+        self.batch_size = batch_size
+        self.diffs = diffs
+        self.shards = None
+        if (shards is not None) and os.path.isfile(os.path.join(WDIR, shards, 'index.pkl')):
+            self._load_shards(shards)
+            return
+        
+        self.days, self.futures, anchors, shift = [], [], [], 0
+        for d, day in enumerate(index['days']):
+            events = dict([(key, np.load(os.path.join(WDIR, filename, day, key + '.npy'), 
+                                         mmap_mode='r')) for key in EVENT_KEYS])
+            T = events['Time']
+            max_end = np.searchsorted(T, T[-1] - self.times.max(), side='right') - 1
+            self.days.append(events)
+            self.futures.append(_day_futures(os.path.join(WDIR, filename, day), T, self.times))
+            shift = max(shift, max_shift(events['Pmid'], self.futures[-1], max_end))
+            # the first anchor with the input_length - 1 preceding messages
+            pos = np.arange(max(input_length - 2, 0), max_end + 1)
+            anchors.append(np.c_[np.full(len(pos), d), pos])
+        self.anchors = np.concatenate(anchors)
+        self._set_limits(len(self.anchors))
+        self.lossless = shift <= index.get('margin', 0)
+        if verbose > 0:
+            print('%d days, %d samples read from %s' % (len(self.days), len(self.anchors), filename))
+            if not self.lossless:
+                print('the mid price moves up to %d ticks within the horizons, more than the '
+                      'margin %d of the ingested bands; future book states are clipped' 
+                      % (shift, index.get('margin', 0)))
+            
+    def indices(self, mode):
+        """
+        Anchors carry their own history, so the samples of each share start at
+        the share's first anchor.
+        """
+        return super(LOBSTERDaysGenerator, self).indices(mode) - self.input_length
+            
+    def _get_ith_sample(self, i, return_xy=False):
+        if self.shards is not None:
+            return self._shard_sample(i, return_xy=return_xy)
+        d, j = self.anchors[i]
+        return self._event_sample(self.days[d], self.futures[d][:, j], j, 
+                                  return_xy=return_xy)
+                                  
+
+def _day_futures(day_dir, T, horizons, chunksize=1000000):
+    """
+    Function that returns future_indices of the memory-mapped event times of
+    a trading day, computed in chunks and cached as a memory-mapped .npy file 
+    in the day's directory.
+    """
+    path = os.path.join(day_dir, 'futures_%s.npy' % '_'.join('%g' % h for h in horizons))
+    if not os.path.isfile(path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        F = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32, shape=(len(horizons), len(T)))
+        for a in range(0, len(T), chunksize):
+            t = np.asarray(T[a: a + chunksize])
+            for k, h in enumerate(horizons):
+                F[k, a: a + len(t)] = np.searchsorted(T, t + h, side='right') - 1
+        F.flush()
+        del F
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
+    
+
+# parameters the samples depend on (validated when shards are loaded) and the 
+# share limits derived from them
+SHARD_PARAMS = ['source', 'compact', 'file_lvl', 'keep_lvl', 'input_length', 'output_length', 
+                'diffs', 'limit', 'train_share', 'batch_size']
+SHARD_KEYS = SHARD_PARAMS + ['n_train', 'n_valid', 'n_test', 'test', 'lossless']
+_shard_generator = None
+
+def _init_shard_worker(generator):
+    global _shard_generator
+    _shard_generator = generator
+    
+    
+def _write_shard(task):
+    path, k, start, stop = task
+    x = np.array([_shard_generator._get_ith_sample(i) for i in range(start, stop)], 
+                 dtype=np.float32)
+    np.save(os.path.join(path, 'shard%05d.npy' % k), x)
+    
+    
+def _read_day(day, file_lvl, chunksize):
+    """
+    Generator that yields chunks of messages and book states of a trading day
+    restricted to the trading hours.
+    """
+    messages = pd.read_csv(os.path.join(day, 'message.csv'), names=MESSAGE_COLUMNS, 
+                           chunksize=chunksize)
+    books = pd.read_csv(os.path.join(day, 'orderbook.csv'), names=book_columns(file_lvl),
+                        chunksize=chunksize)
+    for mess, book in zip(messages, books):
+        ok = np.array((mess['Time'] >= OPEN_TIME) & (mess['Time'] <= CLOSE_TIME))
+        yield mess.loc[ok], book.loc[ok]
+        
+        
+def ingest(days, out_dir, keep_lvl=10, train_share=(.8, 1), chunksize=100000, 
+           margin=10, verbose=1):
+    """
+    Function that preprocesses many trading days of LOBSTER data in chunks 
+    and writes them to per-day memory-mapped arrays in the compact 
+    representation (see event_arrays), readable by LOBSTERDaysGenerator.
+    Volumes are normalized with the statistics of the training share of all 
+    events.
+    Arguments:
+        days        - list of directories (relative to WDIR) with message.csv 
+                      and orderbook.csv files; names should end with 
+                      '_<number of levels>', as for LOBSTERGenerator
+        out_dir     - output directory (relative to WDIR)
+        keep_lvl    - no. of price ticks stored on each side of the mid price
+        train_share - delimiters of the shares, as for generators; only the 
+                      first one is used here
+        chunksize   - no. of csv rows read at once
+        margin      - no. of extra ticks stored on each side of the band (see
+                      event_arrays); generators whose horizons see larger mid
+                      price moves are not lossless
+    Returns
+        dictionary saved as 'index.pkl' in out_dir
+    """
+    t0 = time.time()
+    days = sorted(days)
+    file_lvl = int(days[0].split('_')[-1])
+    paths = [os.path.join(WDIR, day) for day in days]
+    lengths = []
+    for path in paths:
+        T = pd.read_csv(os.path.join(path, 'message.csv'), names=MESSAGE_COLUMNS, 
+                        usecols=['Time'], chunksize=chunksize)
+        lengths.append(int(np.sum([((t['Time'] >= OPEN_TIME) & (t['Time'] <= CLOSE_TIME)).sum() for t in T])))
+    n_train = int(np.sum(lengths) * train_share[0])
+    if verbose > 0:
+        print('time = %.2fs, %d days with %d events counted. Computing statistics...' % (time.time() - t0, len(days), np.sum(lengths)))
+        
+    # volume statistics over the training share
+    Bmoments, Mmoments, n = utils.RunningMoments(), utils.RunningMoments(), 0
+    Vcols = [c for c in book_columns(file_lvl) if 'V' in c]
+    for path in paths:
+        if n >= n_train:
+            break
+        for mess, book in _read_day(path, file_lvl, chunksize):
+            m = min(len(mess), n_train - n)
+            Bmoments.update(np.array(book[Vcols])[:m].ravel())
+            Mmoments.update(np.array(mess['Size'])[:m])
+            n += m
+            if n >= n_train:
+                break
+    stats = {'Bmean': Bmoments.mean, 'Bstd': Bmoments.std(), 
+             'Mmean': Mmoments.mean, 'Mstd': Mmoments.std(ddof=1)}
+    Bscale = stats['Bstd'] + 1e-6*(stats['Bstd'] == 0)
+    Mscale = stats['Mstd'] + 1e-6*(stats['Mstd'] == 0)
+    if verbose > 0:
+        print('time = %.2fs, statistics computed. Writing arrays...' % (time.time() - t0))
+        
+    lvls = np.arange(1, file_lvl + 1)
+    for day, path, length in zip(days, paths, lengths):
+        day_dir = os.path.join(WDIR, out_dir, os.path.basename(day))
+        if not os.path.exists(day_dir):
+            os.makedirs(day_dir)
+        out = {}
+        for key, dtype, shape in zip(EVENT_KEYS, EVENT_DTYPES, [(), (), (), (), (), (2*(keep_lvl + margin),)]):
+            out[key] = np.lib.format.open_memmap(os.path.join(day_dir, key + '.npy'), mode='w+', 
+                                                 dtype=dtype, shape=(length,) + shape)
+        n = 0
+        for mess, book in _read_day(path, file_lvl, chunksize):
+            mess = mess.assign(Size=(mess['Size'] - stats['Mmean']) / Mscale * mess['Direction'])
+            levels = [np.array(book[['%s %d' % (c, lvl) for lvl in lvls]]) 
+                      for c in ['AskP', 'AskV', 'BidP', 'BidV']]
+            for j in [1, 3]:
+                levels[j] = (levels[j] - stats['Bmean']) / Bscale
+            Pmid = np.array(((book['AskP 1'] + book['BidP 1'])//200 + 1) * 100)
+            for key, arr in event_arrays(mess, levels, Pmid, keep_lvl, margin=margin).items():
+                out[key][n: n + len(mess)] = arr
+            n += len(mess)
+        for arr in out.values():
+            arr.flush()
+        del out
+        if verbose > 0:
+            print('time = %.2fs, %s written' % (time.time() - t0, day_dir))
+    index = {'days': [os.path.basename(day) for day in days], 'lengths': lengths,
+             'keep_lvl': keep_lvl, 'margin': margin, 'file_lvl': file_lvl, 'train_share': train_share,
+             'stats': stats}
+    pd.to_pickle(index, os.path.join(WDIR, out_dir, 'index.pkl'))
+    return index
         
 #    def _get_ith_sample(self, i, return_xy=False):
 ##        print('getting sample at %dth position, time = %f' % (i, time.time() - self.tt))
@@ -10,7 +10,7 @@ param_dict = dict(
     verbose = [1 + int(log)],       # verbosity
     train_share = [(.8, .9, 1.)],       # delimeters of the training and validation shares
     input_length = [60],            # input length (1 - stateful lstm)
-    output_length = [1],            # no. of timesteps to predict (only 1 impelemented)
+    output_length = [1],            # no. of timesteps to predict at once (direct multi-step forecast)
     batch_size = [64],             # batch size
     objective=['regr'],             # only 'regr' (regression) implemented
     diffs = [False],                # if True, work on 1st difference of series instead of original
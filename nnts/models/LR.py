@@ -11,7 +11,7 @@ param_dict = dict(
     verbose = [1 + int(log)],   # verbosity
     train_share = [(.7, .8, 1.)],   # delimeters of the training and validation shares
     input_length = [60],        # input length 
-    output_length = [1],        # no. of timesteps to predict (only 1 impelemented)
+    output_length = [1],        # no. of timesteps to predict at once (direct multi-step forecast)
     batch_size = [128],         # batch size
     objective=['regr'],         # only 'regr' (regression) implemented
     diffs = [False],            # if yes, work on 1st difference of series instead of original
@@ -21,6 +21,8 @@ param_dict = dict(
     reduce_nb = [1],            # no. of learning rate reductions
     lr = [.001],                # initial learning rate
     clipnorm = [1000.0],         # max gradient norm
+    solver = ['adam'],          # 'adam' (gradient descent) or 'ridge' (closed form ridge regression)
+    alphas = [[0., 1e-4, 1e-3, 1e-2, 1e-1, 1., 10.]],   # ridge penalties to choose from on validation share (solver='ridge')
 )
 
 if __name__ == '__main__':
@@ -29,11 +31,80 @@ else:
     from .. import *
     from ..utils import *
             
+def moments(batches):
+    """
+    Function that accumulates, in one pass over (X, y) batches, the 
+    statistics needed to fit and evaluate linear models on them.
+    Returns
+        dictionary with no. of samples 'n', sums 'Sx', 'Sy', cross-products 
+        'XtX', 'Xty' and per-column sums of squares 'yty'
+    """
+    m = None
+    for X, y in batches:
+        X, y = np.asarray(X, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        if m is None:
+            m = {'n': 0, 'Sx': 0., 'Sy': 0., 'XtX': 0., 'Xty': 0., 'yty': 0.}
+        m['n'] += X.shape[0]
+        m['Sx'] += X.sum(axis=0)
+        m['Sy'] += y.sum(axis=0)
+        m['XtX'] += X.T.dot(X)
+        m['Xty'] += X.T.dot(y)
+        m['yty'] += (y**2).sum(axis=0)
+    return m
+
+
+def ridge_path(m, alphas):
+    """
+    Function that solves ridge regression (with unpenalized intercept) 
+        min_{W, b} mean squared error + alpha * ||W||^2
+    for all penalties in 'alphas' from a single eigendecomposition of the 
+    centered cross-product matrix.
+    Arguments:
+        m           - statistics returned by moments
+        alphas      - list of penalties
+    Returns
+        list of (W, b) tuples
+    """
+    n = m['n']
+    mx, my = m['Sx'] / n, m['Sy'] / n
+    Sxx = m['XtX'] - n * np.outer(mx, mx)
+    Sxy = m['Xty'] - n * np.outer(mx, my)
+    lam, V = np.linalg.eigh(Sxx)
+    VtSxy = V.T.dot(Sxy)
+    eps = max(lam.max(), 0) * len(lam) * np.finfo(np.float64).eps
+    path = []
+    for alpha in alphas:
+        d = lam + n * alpha
+        inv = np.where(d > eps, 1. / np.maximum(d, eps), 0.)
+        W = V.dot(inv[:, None] * VtSxy)
+        path.append((W, my - mx.dot(W)))
+    return path
+
+
+def mse(m, W, b):
+    """
+    Returns mean squared error of the linear model X.dot(W) + b on the data 
+    summarized by the statistics m (see moments).
+    """
+    sse = m['yty'] - 2 * (W * m['Xty']).sum(axis=0) - 2 * b * m['Sy'] \
+          + (W * m['XtX'].dot(W)).sum(axis=0) + 2 * b * m['Sx'].dot(W) + m['n'] * b**2
+    return sse.sum() / (m['n'] * len(b))
+    
+            
 class LRmodel(utils.Model):
     """
     Class defines the Linear Regression model structure to be passed to 
     utils.ModelRunner.
+    With solver='ridge' the model is not trained by gradient descent: ridge
+    regression is solved in closed form for all penalties in 'alphas' from 
+    statistics gathered in one pass over the training share, and the 
+    solution best on the validation share is loaded into the network.
     """  
+    def _set_params(self, params):
+        self.solver = 'adam'
+        self.alphas = [0., 1e-4, 1e-3, 1e-2, 1e-1, 1., 10.]
+        super(LRmodel, self)._set_params(params)
+        
     def build(self):
         """
         Function has to return:
@@ -47,7 +118,8 @@ class LRmodel(utils.Model):
         # network architecture
         inp = Input(shape=(self.input_length * self.idim,), dtype='float32', 
                     name='value_input')
-        out = Dense(self.output_length * self.odim, activation='softmax')(inp)
+        out = Dense(self.output_length * self.odim, 
+                    activation='linear' if (self.solver == 'ridge') else 'softmax')(inp)
         
         nn = keras.models.Model(inputs=inp, outputs=out)
      
@@ -63,6 +135,37 @@ class LRmodel(utils.Model):
                                     reduce_nb=self.reduce_nb, verbose=self.verbose, 
                                     monitor='val_loss', restore_best=False)]
         return nn, io_func, callbacks
+    
+    def run(self):
+        """
+        Returns:
+            dictionary in the format of keras History.history, with one 
+            entry per penalty in 'alphas' if solver='ridge',
+            kera.models.Model object
+        """
+        if self.solver != 'ridge':
+            return super(LRmodel, self).run()
+        print('Total model parameters: %d' % get_param_no(self.nn))
+        t0 = time.time()
+        modes = ['train', 'valid'] + (['test'] if self.G.test else [])
+        stats = dict([(mode, moments(self.G.batches(mode, func=self.io_func, 
+                                                     batch_size=self.eval_batch_size))) 
+                      for mode in modes])
+        if self.verbose > 0:
+            print('time = %.2fs, cross-products computed' % (time.time() - t0))
+        alphas = sorted(self.alphas)
+        path = ridge_path(stats['train'], alphas)
+        names = {'train': 'loss', 'valid': 'val_loss', 'test': 'test_loss'}
+        history = dict([(names[mode], [mse(stats[mode], W, b) for W, b in path]) 
+                        for mode in modes])
+        history['epoch_time'] = [time.time() - t0] * len(alphas)
+        best = int(np.argmin(history['val_loss']))
+        self.nn.layers[-1].set_weights([path[best][0].astype(np.float32), 
+                                        path[best][1].astype(np.float32)])
+        if self.verbose > 0:
+            print('time = %.2fs, ridge path solved; alpha = %g, val_loss = %f' 
+                  % (time.time() - t0, alphas[best], history['val_loss'][best]))
+        return history, self.nn
 
 # Runs a grid search for the above model    
 if __name__ == '__main__':
@@ -35,6 +35,7 @@ if __name__ == '__main__':
 else:
     from .. import *
     from ..utils import *
+    from .. import inference
     
 class LSTMmodel(utils.Model):
     """
@@ -91,6 +92,13 @@ class LSTMmodel(utils.Model):
                                           monitor='val_loss', restore_best=True, 
                                           reset_states=True)]
         return nn, io_func, callbacks
+
+    def session(self, capacity=64):
+        """
+        Returns nnts.inference.LSTMSession that keeps the states of the trained
+        network per series id, for online prediction of many series.
+        """
+        return inference.LSTMSession(inference.extract_specs(self.nn), capacity=capacity)
         
 
 # Runs a grid search for the above model   
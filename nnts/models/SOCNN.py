@@ -9,7 +9,7 @@ param_dict = dict(
     verbose = [1 + int(log)],       # verbosity
     train_share = [(.8, .9, 1.)],       # delimeters of the training and validation shares
     input_length = [60],            # input length (1 - stateful lstm)
-    output_length = [1],            # no. of timesteps to predict (only 1 impelemented)
+    output_length = [1],            # no. of timesteps to predict at once (direct multi-step forecast)
     batch_size = [64],             # batch size
     objective=['regr'],             # only 'regr' (regression) implemented
     diffs = [True],                # if True, work on 1st difference of series instead of original
@@ -131,7 +131,7 @@ class SOCNNmodel(utils.Model):
                                         kernel_constraint=nonneg() if self.nonnegative else None),
                                   name= 'out')(main)
         else: 
-            outL = LocallyConnected1D(filters=1, kernel_size=1,   # dimensions permuted. time dimension treated as separate channels, no connections between different features
+            outL = LocallyConnected1D(filters=self.output_length, kernel_size=1,   # dimensions permuted. time dimension treated as separate channels, no connections between different features
                                       padding='valid')
             out = outL(main)
             
@@ -0,0 +1,115 @@
+"""
+This file provides the preprocessing of new observations for trained models.
+
+A Preprocessor holds the preprocessing state of a generator: the column
+order, the excluded columns, the differenced columns with their last raw
+values and the training share means and stds. It applies the generator's
+transformation (1st differences and normalization) to single ticks or small
+batches of raw rows in O(no. of columns), without building DataFrames, and
+is saved as a small JSON file next to the trained network (ModelRunner writes
+it with the .prep extension). This file imports nothing but numpy.
+"""
+import json
+import numpy as np
+
+
+class Preprocessor(object):
+    """
+    Class that transforms raw observations as the generator transformed its
+    series.
+    Initialization arguments:
+        columns     - columns of the raw rows, in order
+        cols        - columns of the transformed rows (the generator's cols)
+        means, stds - normalization statistics of cols
+        diff_cols   - differenced columns (subset of cols)
+        last        - last raw values of diff_cols (None - unknown; the 1st
+                      transformed row is then NaN in these columns)
+    """
+    def __init__(self, columns, cols, means, stds, diff_cols=[], last=None):
+        self.columns = list(columns)
+        self.cols = list(cols)
+        self.excluded = [c for c in self.columns if c not in self.cols]
+        self.means = np.asarray(means, dtype=np.float64)
+        self.stds = np.asarray(stds, dtype=np.float64)
+        self.diff_cols = [c for c in self.cols if c in diff_cols]
+        self.ids = np.array([self.columns.index(c) for c in self.cols], dtype=int)
+        self.dids = np.array([self.cols.index(c) for c in self.diff_cols], dtype=int)
+        self.last = None if (last is None) else np.asarray(last, dtype=np.float64)
+
+    @classmethod
+    def from_generator(cls, G):
+        """
+        Returns Preprocessor of nnts.utils.Generator G; the last raw values are
+        those of the end of G's series. The raw rows have the columns of G.X,
+        or G.cols for generators that keep no dense X (e.g. household events).
+        """
+        means = np.asarray(G.means[G.cols], dtype=np.float64)
+        stds = np.asarray(G.stds[G.cols], dtype=np.float64)
+        stds = stds + (stds == 0)*.001
+        base = getattr(G, 'diff_base', None)
+        diff_cols = [] if (base is None) else [c for c in G.cols if (c in base.index) and (base[c] == base[c])]
+        last = None
+        if len(diff_cols) > 0:
+            k = [G.cols.index(c) for c in diff_cols]
+            d = np.asarray(G.asarray(diff_cols), dtype=np.float64) * stds[k] + means[k]
+            last = np.asarray(base[diff_cols], dtype=np.float64) + d.sum(axis=0)
+        columns = list(G.X.columns)
+        if not set(G.cols) <= set(columns):
+            columns = list(G.cols)
+        return cls(columns, G.cols, means, stds, diff_cols=diff_cols, last=last)
+
+    def reset(self, row):
+        """
+        Sets the last raw values from the raw row (or dictionary column ->
+        value) 'row', without transforming it.
+        """
+        row = self._row(row)
+        self.last = np.asarray(row, dtype=np.float64)[self.ids][self.dids]
+
+    def _row(self, row):
+        if type(row) == dict:
+            return [row[c] for c in self.columns]
+        return row
+
+    def transform(self, rows):
+        """
+        Function that transforms raw rows, updating the last raw values.
+        Arguments:
+            rows        - raw row (numpy.array of len(columns) values, or
+                          dictionary column -> value) or 2d numpy.array of
+                          consecutive raw rows
+        Returns
+            float32 numpy.array of the transformed row(s), columns as of cols
+        """
+        x = np.asarray(self._row(rows), dtype=np.float64)
+        single = x.ndim == 1
+        x = np.atleast_2d(x)[:, self.ids]
+        if len(self.dids) > 0:
+            raw = x[:, self.dids]
+            prev = np.empty_like(raw)
+            prev[0] = np.nan if (self.last is None) else self.last
+            prev[1:] = raw[:-1]
+            self.last = raw[-1].copy()
+            x[:, self.dids] = raw - prev
+        x -= self.means
+        x /= self.stds
+        x = x.astype(np.float32)
+        return x[0] if single else x
+
+    def save(self, path):
+        """
+        Saves the preprocessor to a JSON file 'path'.
+        """
+        with open(path, 'w') as f:
+            json.dump({'columns': [str(c) for c in self.columns], 'cols': [str(c) for c in self.cols],
+                       'means': self.means.tolist(), 'stds': self.stds.tolist(),
+                       'diff_cols': [str(c) for c in self.diff_cols],
+                       'last': None if (self.last is None) else self.last.tolist()}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns Preprocessor saved by save.
+        """
+        with open(path) as f:
+            return cls(**json.load(f))
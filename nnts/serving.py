@@ -0,0 +1,596 @@
+"""
+This file provides a local forecasting service for trained models.
+
+ForecastService collects concurrent prediction requests into dynamic
+micro-batches: a worker thread waits for the first request, gathers further
+ones until max_batch requests are collected or the deadline (counted from the
+arrival of the first one) passes, and answers all of them with a single
+predict call. serve() exposes a service as JSON over HTTP on a local port and
+load_generator() measures a service with concurrent clients, in-process or
+over HTTP.
+
+ModelRegistry serves many trained networks (e.g. one per meter or instrument):
+it indexes the networks saved by ModelRunner by series id from the results
+file, loads them lazily into a memory-bounded LRU cache and prefetches, in
+a background thread, the networks with the highest decayed request frequency.
+A ForecastService built on a registry routes each request by its key;
+requests for a network being loaded are answered by the loading thread, so
+they do not hold up the requests for loaded networks.
+
+Usage (from the package directory):
+    python -m nnts.serving --model=<.h5 or .npz file> [--port=8000]
+                           [--max_batch=64] [--deadline=.005]
+    python -m nnts.serving --results=<results file> [--key=data] ...
+"""
+from ._imports_ import *
+from . import inference
+from .config import WDIR
+import collections
+import heapq
+import json
+import queue
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+
+
+def load_artifact(path):
+    """
+    Function that loads a trained model.
+    Arguments:
+        path        - path (absolute or relative to WDIR) of a network saved by
+                      ModelRunner (.h5) or exported by nnts.inference.export
+                      (.npz)
+    Returns
+        object with predict method (keras.models.Model,
+        nnts.inference.Predictor or nnts.inference.LSTMSession)
+    """
+    path = os.path.join(WDIR, path)
+    if path.endswith('.npz'):
+        return inference.load(path)
+    return load_model(path)
+
+
+class _GraphModel(object):
+    """
+    Keras network not supported by nnts.inference, with the graph and the
+    session of its own, which are freed by close.
+    """
+    def __init__(self, nn, graph, session):
+        self.nn, self.graph, self.session = nn, graph, session
+        with graph.as_default():
+            self.nn._make_predict_function()
+        self.lock = threading.Lock()
+
+    def count_params(self):
+        return self.nn.count_params()
+
+    def predict(self, X):
+        with self.lock:
+            if self.session is None:
+                raise RuntimeError('the network was evicted from the registry')
+            with self.graph.as_default(), self.session.as_default():
+                return self.nn.predict(X)
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+            self.nn, self.graph, self.session = None, None, None
+
+
+def _nbytes(model):
+    """
+    Returns the (approximate) memory used by the weights of a loaded model.
+    """
+    if hasattr(model, 'specs'):
+        return inference.nbytes(model.specs)
+    return 4 * model.count_params()
+
+
+def _best(v):
+    """
+    Returns the best (lowest) value of a results entry (number or history
+    list); missing values rank last.
+    """
+    v = np.asarray(v, dtype=float).ravel()
+    v = v[~np.isnan(v)]
+    return v.min() if len(v) > 0 else np.inf
+
+
+class ModelRegistry(object):
+    """
+    Class that indexes trained networks by series id and loads them lazily
+    into a memory-bounded LRU cache.
+    Initialization arguments:
+        results_file - results pickle written by ModelRunner (path relative to
+                      WDIR); an .npz file exported (nnts.inference.export)
+                      next to a saved .h5 file is loaded instead of it
+        key         - results column identifying the series; if several
+                      networks have the same key, the one with the best metric
+                      is used
+        metric      - results column (loss or loss history) to choose by
+        max_bytes   - memory budget for the weights of the loaded networks
+        prefetch    - maximal no. of networks loaded ahead after a request
+        half_life   - half-life (in seconds) of the request frequencies
+                      used to predict the hot networks
+    Keras networks are converted to the numpy forward pass of nnts.inference
+    in a graph and session of their own, which are closed right away, so
+    evicting a network frees its memory. Networks nnts.inference does not
+    support keep their own graph and session until evicted.
+    """
+    def __init__(self, results_file, key='data', metric='val_loss', max_bytes=2**30,
+                 prefetch=2, half_life=60.):
+        results = pd.read_pickle(os.path.join(WDIR, results_file))
+        self.index = {}
+        for r in results.T.to_dict().values():
+            if (r[key] not in self.index) or (_best(r[metric]) < _best(self.index[r[key]][metric])):
+                self.index[r[key]] = r
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self.half_life = half_life
+        self.cache = collections.OrderedDict()  # key -> (model, bytes)
+        self.nbytes = 0
+        self.loading = {}                       # key -> Future
+        self.queued = set()                     # keys waiting for prefetching
+        self.scores = {}                        # key -> decayed request frequency * 2**(t/half_life)
+        self.time0 = time.time()
+        self.hits, self.misses, self.prefetched, self.evicted = 0, 0, 0, 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)   # prefetching
+        self.loader = ThreadPoolExecutor(max_workers=2)     # loading on a miss
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def metadata(self, key):
+        """
+        Returns the results entry (parameters, losses, file names) of the
+        network for 'key'.
+        """
+        return self.index[key]
+
+    def find(self, **conditions):
+        """
+        Returns keys of the networks whose results entries match all the
+        given column values.
+        """
+        return [k for k, r in self.index.items()
+                if all(r.get(c) == v for c, v in conditions.items())]
+
+    def path(self, key):
+        path = os.path.join(WDIR, self.index[key]['hdf5'])
+        npz = path[:-3] + '.npz'
+        return npz if (path.endswith('.h5') and os.path.isfile(npz)) else path
+
+    def _touch(self, key):
+        t = (time.time() - self.time0) / self.half_life
+        if t > 500:
+            # rescales the scores to avoid overflow
+            self.scores = {k: v * 2.**-t for k, v in self.scores.items()}
+            self.time0, t = time.time(), 0.
+        self.scores[key] = self.scores.get(key, 0.) + 2.**t
+
+    def _load(self, key):
+        path = self.path(key)
+        if path.endswith('.npz') or (K._BACKEND != 'tensorflow'):
+            return load_artifact(path)
+        graph = tf.Graph()
+        session = tf.Session(graph=graph)
+        with graph.as_default(), session.as_default():
+            nn = load_model(path)
+            try:
+                model = inference.from_specs(inference.extract_specs(nn))
+            except NotImplementedError:
+                return _GraphModel(nn, graph, session)
+        session.close()
+        return model
+
+    def _fetch(self, key):
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key][0]
+            f = self.loading.get(key)
+            owner = f is None
+            if owner:
+                f = self.loading[key] = Future()
+        if not owner:
+            return f.result()
+        try:
+            model = self._load(key)
+        except Exception as e:
+            with self.lock:
+                self.loading.pop(key)
+            f.set_exception(e)
+            raise
+        size = _nbytes(model)
+        with self.lock:
+            self.cache[key] = (model, size)
+            self.nbytes += size
+            while (self.nbytes > self.max_bytes) and (len(self.cache) > 1):
+                evicted, size = self.cache.popitem(last=False)[1]
+                self.nbytes -= size
+                self.evicted += 1
+                if hasattr(evicted, 'close'):
+                    evicted.close()
+            self.loading.pop(key)
+        f.set_result(model)
+        return model
+
+    def _prefetch_one(self, key):
+        try:
+            self._fetch(key)
+            with self.lock:
+                self.prefetched += 1
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.queued.discard(key)
+
+    def get(self, key):
+        """
+        Returns the loaded network for 'key', loading it if needed, and starts
+        prefetching the hot networks.
+        """
+        return self.get_async(key).result()
+
+    def get_async(self, key):
+        """
+        Returns concurrent.futures.Future of the loaded network for 'key'
+        (done if it is loaded; otherwise loaded in a background thread, one
+        future per network) and starts prefetching the hot networks.
+        """
+        if key not in self.index:
+            raise KeyError('no model for ' + repr(key))
+        with self.lock:
+            self._touch(key)
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                model = self.cache[key][0]
+            else:
+                self.misses += 1
+                model = None
+            hot = heapq.nlargest(len(self.cache) + self.prefetch, self.scores, key=self.scores.get) \
+                  if (self.prefetch > 0) else []
+            # with the cache full, only networks hotter than the coldest loaded one are prefetched
+            full = self.nbytes * (1. + 1. / max(len(self.cache), 1)) > self.max_bytes
+            floor = min(self.scores.get(k, 0.) for k in self.cache) if (full and self.cache) else -np.inf
+            hot = [k for k in hot if (k != key) and (self.scores[k] > floor) and (k not in self.cache) and
+                   (k not in self.loading) and (k not in self.queued)][:self.prefetch]
+            self.queued.update(hot)
+        for k in hot:
+            self.executor.submit(self._prefetch_one, k)
+        if model is None:
+            with self.lock:
+                f = self.loading.get(key)
+            return self.loader.submit(self._fetch, key) if (f is None) else f
+        f = Future()
+        f.set_result(model)
+        return f
+
+    def stats(self):
+        """
+        Returns dictionary with the no. of loaded networks, their memory and
+        the no. of cache hits, misses, prefetched and evicted networks.
+        """
+        with self.lock:
+            return {'loaded': len(self.cache), 'bytes': self.nbytes, 'hits': self.hits,
+                    'misses': self.misses, 'prefetched': self.prefetched, 'evicted': self.evicted}
+
+
+def _stack(xs):
+    if type(xs[0]) == dict:
+        return {k: np.stack([np.asarray(x[k]) for x in xs]) for k in xs[0]}
+    if type(xs[0]) == list:
+        return [np.stack([np.asarray(x[j]) for x in xs]) for j in range(len(xs[0]))]
+    return np.stack([np.asarray(x) for x in xs])
+
+
+def _take(X, i):
+    if type(X) == dict:
+        return {k: v[i] for k, v in X.items()}
+    if type(X) == list:
+        return [v[i] for v in X]
+    return X[i]
+
+
+def _tolist(y):
+    if type(y) == dict:
+        return {k: _tolist(v) for k, v in y.items()}
+    if type(y) == list:
+        return [_tolist(v) for v in y]
+    return np.asarray(y).tolist()
+
+
+def _percentiles(latencies):
+    if len(latencies) == 0:
+        return np.nan, np.nan
+    return tuple(float(p) for p in np.percentile(np.array(latencies), [50, 99]))
+
+
+class ForecastService(object):
+    """
+    Class that answers prediction requests for a model with dynamic
+    micro-batching.
+    Initialization arguments:
+        model       - object with predict method taking a batch of inputs
+                      (keras.models.Model, nnts.inference.Predictor), path
+                      passed to load_artifact or ModelRegistry object (then
+                      requests are batched per key)
+        max_batch   - maximal no. of requests answered by one predict call
+        deadline    - maximal time (in seconds) a request waits for its batch
+                      to fill
+        window      - no. of the latest requests the latency percentiles are
+                      computed from
+    """
+    def __init__(self, model, max_batch=64, deadline=.005, window=10000):
+        self.model = load_artifact(model) if isinstance(model, str) else model
+        if not (isinstance(self.model, ModelRegistry) or hasattr(self.model, 'predict')):
+            raise TypeError('%s has no predict method and cannot be served' % type(self.model).__name__)
+        self.max_batch = max_batch
+        self.deadline = deadline
+        self.latencies = collections.deque(maxlen=window)
+        self.n_requests, self.n_batches = 0, 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.graph = None
+        if hasattr(self.model, '_make_predict_function') and (K._BACKEND == 'tensorflow'):
+            # keras models are called from the worker thread
+            self.model._make_predict_function()
+            self.graph = tf.get_default_graph()
+        self.time0 = time.time()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, x, key=None):
+        """
+        Function that queues a request.
+        Arguments:
+            x           - single input of the model (numpy.array, or dictionary
+                          or list of numpy.arrays for multi-input networks),
+                          without the batch dimension
+            key         - series id of the model (if served from a registry)
+        Returns
+            concurrent.futures.Future with the prediction
+        """
+        f = Future()
+        self.requests.put((time.time(), x, f, key))
+        return f
+
+    def predict(self, x, key=None, timeout=None):
+        """
+        Returns prediction for a single input x (see self.submit).
+        """
+        return self.submit(x, key=key).result(timeout)
+
+    def _worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch = [item]
+            end = item[0] + self.deadline
+            while len(batch) < self.max_batch:
+                wait = end - time.time()
+                try:
+                    item = self.requests.get(timeout=wait) if (wait > 0) else self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    break
+                batch.append(item)
+            self._run(batch)
+
+    def _predict(self, model, X):
+        if isinstance(model, inference.Predictor):
+            x, v = inference._split_inputs(X)
+            return model.predict(x, value_input=v)
+        if self.graph is not None:
+            with self.graph.as_default():
+                return model.predict(X)
+        return model.predict(X)
+
+    def _run(self, batch):
+        groups = collections.OrderedDict()
+        for item in batch:
+            groups.setdefault(item[3], []).append(item)
+        for key, group in groups.items():
+            if not isinstance(self.model, ModelRegistry):
+                self._answer(group, self.model)
+                continue
+            try:
+                f = self.model.get_async(key)
+            except Exception as e:
+                f = Future()
+                f.set_exception(e)
+            if f.done():
+                self._answer(group, f)
+            else:
+                # the network is loaded in the background; its requests are
+                # answered by the loading thread, the worker goes on
+                f.add_done_callback(lambda f, group=group: self._answer(group, f))
+
+    def _answer(self, group, model):
+        try:
+            if isinstance(model, Future):
+                model = model.result()
+            Y = self._predict(model, _stack([x for _, x, _, _ in group]))
+            for i, (_, _, f, _) in enumerate(group):
+                f.set_result(_take(Y, i))
+        except Exception as e:
+            for _, _, f, _ in group:
+                f.set_exception(e)
+        now = time.time()
+        with self.lock:
+            self.latencies.extend([now - item[0] for item in group])
+            self.n_requests += len(group)
+            self.n_batches += 1
+
+    def stats(self):
+        """
+        Returns dictionary with the no. of answered requests and batches, mean
+        batch size, throughput (requests per second since the start),
+        p50 / p99 latency (in seconds) of the latest requests and the
+        registry stats (if served from a registry).
+        """
+        with self.lock:
+            p50, p99 = _percentiles(self.latencies)
+            stats = {'requests': self.n_requests, 'batches': self.n_batches,
+                     'mean_batch': self.n_requests / max(self.n_batches, 1),
+                     'throughput': self.n_requests / (time.time() - self.time0),
+                     'p50': p50, 'p99': p99}
+        if isinstance(self.model, ModelRegistry):
+            stats['registry'] = self.model.stats()
+        return stats
+
+    def close(self):
+        """
+        Stops the worker thread after answering the queued requests.
+        """
+        self.requests.put(None)
+        self.thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'unknown path ' + self.path})
+        self._reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._reply(404, {'error': 'unknown path ' + self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+            x = body['x']
+            if type(x) == dict:
+                x = {k: np.asarray(v, dtype=np.float32) for k, v in x.items()}
+            else:
+                x = np.asarray(x, dtype=np.float32)
+            self._reply(200, {'y': _tolist(self.server.service.predict(x, key=body.get('key')))})
+        except Exception as e:
+            self._reply(500, {'error': repr(e)})
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(service, host='127.0.0.1', port=0):
+    """
+    Function that starts a HTTP server for 'service' in a background thread.
+    Requests: POST /predict with JSON {"x": input, "key": series id} (input
+    as in ForecastService.submit; dictionary for multi-input networks; key
+    only for services built on a registry) returns
+    {"y": prediction}; GET /stats returns service.stats().
+    Arguments:
+        service     - ForecastService object
+        host, port  - address to listen at (port 0 - any free port)
+    Returns
+        server object; server.server_address gives the address,
+        server.shutdown() stops it
+    """
+    server = _Server((host, port), _Handler)
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _http_predict(url, x, key=None):
+    data = json.dumps({'x': _tolist(x), 'key': key}).encode()
+    req = Request(url + '/predict', data=data, headers={'Content-Type': 'application/json'})
+    with urlopen(req) as r:
+        return json.loads(r.read().decode())['y']
+
+
+def load_generator(target, X, clients=8, requests=1000, keys=None, verbose=1):
+    """
+    Function that sends requests to a service from concurrent clients and
+    measures the latency observed by the clients.
+    Arguments:
+        target      - ForecastService object or url of a server started by
+                      serve, e.g. 'http://127.0.0.1:8000'
+        X           - batch of inputs (as passed to the model's predict);
+                      the requests cycle through its samples
+        clients     - no. of concurrent client threads
+        requests    - total no. of requests
+        keys        - list of series ids the requests cycle through (for
+                      services built on a registry)
+    Returns
+        dictionary with the no. of requests, errors, time, throughput
+        (requests per second) and p50 / p99 latency (in seconds)
+    """
+    n = len(X[list(X.keys())[0]] if (type(X) == dict) else (X[0] if (type(X) == list) else X))
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client(c):
+        for i in range(c, requests, clients):
+            x = _take(X, i % n)
+            key = None if (keys is None) else keys[i % len(keys)]
+            t = time.time()
+            try:
+                if isinstance(target, str):
+                    _http_predict(target, x, key=key)
+                else:
+                    target.predict(x, key=key)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.time() - t)
+
+    t0 = time.time()
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    total = time.time() - t0
+    p50, p99 = _percentiles(latencies)
+    results = {'requests': len(latencies), 'errors': len(errors), 'time': total,
+               'throughput': len(latencies) / total, 'p50': p50, 'p99': p99}
+    if verbose > 0:
+        print('time = %.2fs, requests = %d, errors = %d, throughput = %.1f/s, p50 = %.2fms, p99 = %.2fms' %
+              (total, len(latencies), len(errors), results['throughput'], 1000 * p50, 1000 * p99))
+    return results
+
+
+if __name__ == '__main__':
+    kwargs = dict(a[2:].split('=', 1) for a in sys.argv[1:])
+    model = ModelRegistry(kwargs['results'], key=kwargs.get('key', 'data')) \
+            if ('results' in kwargs) else kwargs['model']
+    service = ForecastService(model, max_batch=int(kwargs.get('max_batch', 64)),
+                              deadline=float(kwargs.get('deadline', .005)))
+    server = serve(service, host=kwargs.get('host', '127.0.0.1'), port=int(kwargs.get('port', 8000)))
+    print('serving %s at http://%s:%d' % ((kwargs.get('results', kwargs.get('model')),) + server.server_address))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
+        service.close()
@@ -0,0 +1,208 @@
+"""
+This file provides utilities for sharing preprocessed generators between
+processes.
+
+A coordinator publishes a generator under its data fingerprint (see
+nnts.utils.data_fingerprint): the generator is pickled with all large numeric
+arrays written to .npy files in OS shared memory (/dev/shm, if available) and
+arrays already memory-mapped from .npy files referenced by their file names.
+Worker processes attach to the published generator, memory-mapping the arrays
+read-only, so all processes use a single copy of the data. Each attached
+process holds a reference file; the shared files are removed when the last
+reference is released.
+"""
+from ._imports_ import *
+import atexit
+import mmap
+import shutil
+import tempfile
+
+SHARED_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+_held = set()
+
+
+def shared_dir(key):
+    return os.path.join(SHARED_ROOT, 'nnts_' + key)
+
+
+def is_published(key):
+    return os.path.isfile(os.path.join(shared_dir(key), 'generator.pkl'))
+
+
+def _npy_file(arr):
+    """
+    Returns (file name, transposed) if 'arr' is a memory map of a whole .npy 
+    file (or its transpose, as kept by pandas), else None.
+    """
+    m = arr
+    while not (isinstance(m, np.memmap) and isinstance(m.base, mmap.mmap)):
+        if not isinstance(m.base, np.ndarray):
+            return None
+        m = m.base
+    filename = getattr(m, 'filename', None)
+    if (filename is None) or (not filename.endswith('.npy')) or \
+            (arr.ctypes.data != m.ctypes.data) or (arr.dtype != m.dtype):
+        return None
+    if (arr.shape, arr.strides) == (m.shape, m.strides):
+        transposed = False
+    elif (arr.shape, arr.strides) == (m.shape[::-1], m.strides[::-1]):
+        transposed = True
+    else:
+        return None
+    header = np.load(filename, mmap_mode='r')
+    if (header.shape == m.shape) and (header.dtype == m.dtype) and (header.offset == m.offset):
+        return filename, transposed
+    return None
+
+
+class _SharingPickler(pickle.Pickler):
+    def __init__(self, file, directory, min_bytes):
+        super(_SharingPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.min_bytes = min_bytes
+        self.written = {}
+
+    def persistent_id(self, obj):
+        if (type(obj) not in [np.ndarray, np.memmap]) or (obj.dtype.kind not in 'biufc') \
+                or (obj.nbytes < self.min_bytes):
+            return None
+        if id(obj) not in self.written:
+            pid = _npy_file(obj)
+            if pid is None:
+                pid = (os.path.join(self.directory, 'array%d.npy' % len(self.written)), False)
+                np.save(pid[0], obj)
+            # keeps obj alive, so that its id is not reused during pickling
+            self.written[id(obj)] = (pid, obj)
+        return self.written[id(obj)][0]
+
+
+class _SharingUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        filename, transposed = pid
+        arr = np.load(filename, mmap_mode='r')
+        return arr.T if transposed else arr
+
+
+def publish(G, key, min_bytes=2**16, verbose=1):
+    """
+    Function that publishes generator G for other processes.
+    Arguments:
+        G           - generator object (any picklable object)
+        key         - identifier, e.g. the data fingerprint of G
+        min_bytes   - smaller arrays are pickled by value
+    """
+    t0 = time.time()
+    directory = shared_dir(key)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # held while writing, so that a failed attach cannot remove the directory
+    _hold(key)
+    tmp = os.path.join(directory, 'generator.%d.tmp' % os.getpid())
+    with open(tmp, 'wb') as f:
+        _SharingPickler(f, directory, min_bytes).dump(G)
+    os.replace(tmp, os.path.join(directory, 'generator.pkl'))
+    if verbose > 0:
+        print("time = %.2fs, generator published in '%s'" % (time.time() - t0, directory))
+
+
+def attach(key):
+    """
+    Function that returns the generator published under 'key', with its
+    large arrays memory-mapped read-only from shared memory, and registers
+    a reference of the current process to it. The reference is taken before
+    the files are read, so a concurrent release cannot remove them midway.
+    Returns
+        the generator, or None if nothing is published under 'key' (or it 
+        was removed meanwhile); the caller then loads the data itself
+    """
+    if not _hold(key):
+        return None
+    try:
+        with open(os.path.join(shared_dir(key), 'generator.pkl'), 'rb') as f:
+            return _SharingUnpickler(f).load()
+    except (OSError, EOFError, pickle.UnpicklingError):
+        _unhold(key)
+        return None
+
+
+def ref_name(tag=None):
+    """
+    Returns name of the reference file of the current process, optionally 
+    distinguished by 'tag' when a process holds several references.
+    """
+    return 'ref.%d' % os.getpid() + ('' if (tag is None) else '.%s' % tag)
+
+
+def hold_directory(directory, ref=None):
+    """
+    Creates the reference file 'ref' (default: ref_name()) in 'directory'; 
+    returns False if the directory does not exist (any more).
+    """
+    try:
+        open(os.path.join(directory, ref_name() if (ref is None) else ref), 'w').close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def release_directory(directory, ref=None):
+    """
+    Removes the reference file 'ref' (default: ref_name()) and those of dead
+    processes from 'directory', and removes the directory if no reference 
+    is left.
+    """
+    if ref is None:
+        ref = ref_name()
+    if not os.path.isdir(directory):
+        return
+    for f in [f for f in os.listdir(directory) if f.startswith('ref.')]:
+        if (f == ref) or (not _alive(int(f.split('.')[1]))):
+            try:
+                os.remove(os.path.join(directory, f))
+            except FileNotFoundError:
+                pass
+    if not any(f.startswith('ref.') for f in os.listdir(directory)):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _hold(key):
+    if not hold_directory(shared_dir(key)):
+        return False
+    _held.add(key)
+    return True
+
+
+def _unhold(key):
+    _held.discard(key)
+    try:
+        os.remove(os.path.join(shared_dir(key), ref_name()))
+    except FileNotFoundError:
+        pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def release(key):
+    """
+    Function that drops the reference of the current process to the data
+    published under 'key' and removes the shared files if no live process
+    holds a reference any more. Arrays mapped earlier remain valid.
+    """
+    _held.discard(key)
+    release_directory(shared_dir(key))
+
+
+def release_all():
+    for key in list(_held):
+        release(key)
+
+
+atexit.register(release_all)
@@ -4,8 +4,10 @@ Utilities file.
 The file contains i.a. the ModelRunner and Generator classes.
 """
 from ._imports_ import *
-from . import keras_utils
+from . import keras_utils, shared, backtest, preprocessing
 from .config import WDIR, SEP
+import hashlib
+import inspect
 
 def list_of_param_dicts(param_dict):
     """
@@ -21,6 +23,118 @@ def list_of_param_dicts(param_dict):
         
 def get_param_no(nn):
     return int(np.sum([np.sum([np.prod(K.eval(w).shape) for w in l.trainable_weights]) for l in nn.layers]))
+
+
+def as_slice(ids):
+    """
+    Returns slice equivalent to the list of indices 'ids' if they are 
+    consecutive and increasing, so that indexing with it returns a view 
+    instead of a copy; otherwise returns 'ids' unchanged.
+    """
+    if (ids is None) or isinstance(ids, slice) or (len(ids) == 0):
+        return ids
+    ids = [int(i) for i in ids]
+    if ids == list(range(ids[0], ids[0] + len(ids))):
+        return slice(ids[0], ids[0] + len(ids))
+    return ids
+
+
+def block_order(order, block_size, block_window):
+    """
+    Function that shuffles 'order' at block granularity: the sorted indices
+    are cut into blocks at the multiples of block_size (so that with 
+    block_size equal to the chunk length of paged data each block lies in 
+    one chunk), the blocks are randomly permuted and the samples are 
+    shuffled within each group of block_window consecutive blocks of the 
+    permuted sequence. At any time, samples are drawn from at most 
+    block_window blocks.
+    Returns
+        numpy.array, a permutation of 'order'
+    """
+    order = np.sort(order)
+    blocks = np.split(order, np.flatnonzero(np.diff(order // block_size)) + 1)
+    perm = np.random.permutation(len(blocks))
+    return np.concatenate([
+        np.random.permutation(np.concatenate([blocks[j] for j in perm[g: g + block_window]]))
+        for g in range(0, len(perm), block_window)
+    ])
+    
+    
+def shuffle_distance(order):
+    """
+    Function that measures how close a sampling order is to a full shuffle:
+    the mean distance between consecutively sampled positions relative to 
+    its expectation (n + 1)/3 for a uniformly random permutation of n 
+    samples. Close to 0 for sequential access and to 1 for a full shuffle.
+    """
+    pos = np.searchsorted(np.sort(order), order)
+    return np.abs(np.diff(pos)).mean() / ((len(order) + 1) / 3.)
+    
+    
+def data_fingerprint(generator_class, datasource, params):
+    """
+    Function that identifies the data produced by a generator: the hash of
+    the generator class, datasource (with its modification time, if it is 
+    a file) and those params that appear in the generator's signature.
+    Returns
+        string of hexadecimal digits
+    """
+    names = inspect.signature(generator_class.__init__).parameters
+    relevant = sorted([(k, repr(v)) for k, v in params.items() if k in names])
+    mtime = None
+    for path in [os.path.join(WDIR, str(datasource)), str(datasource)]:
+        if os.path.exists(path):
+            mtime = os.path.getmtime(path)
+            break
+    key = repr((generator_class.__name__, datasource, mtime, relevant))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+_WINDOWS = {}
+WINDOWS_FORMAT = 1   # bump when the layout of cached samples changes
+
+def generator_code_hash(G):
+    """
+    Returns hash of the source code of generator G's class and its nnts base
+    classes, so that samples cached by an older version of the code (e.g. of 
+    _get_batch) are not reused.
+    """
+    src = [c.__module__ + c.__name__ for c in type(G).__mro__]
+    for c in type(G).__mro__:
+        if c.__module__.startswith('nnts'):
+            try:
+                src.append(inspect.getsource(c))
+            except (OSError, TypeError):
+                pass
+    return hashlib.md5(''.join(src).encode('utf-8')).hexdigest()[:12]
+    
+    
+def cached_windows(G, mode, key, verbose=1):
+    """
+    Function that returns all samples of the 'valid' or 'test' share of 
+    generator G as a read-only array. The samples are materialized once per 
+    data fingerprint 'key' (see data_fingerprint), WINDOWS_FORMAT and code of
+    the generator class (see generator_code_hash) into WDIR/cache, from 
+    where later trials and other processes memory-map them.
+    """
+    if (key, mode) in _WINDOWS:
+        return _WINDOWS[(key, mode)]
+    cache_dir = os.path.join(WDIR, 'cache')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, '%s_%s_v%d_%s.npy' % (key, mode, WINDOWS_FORMAT, 
+                                                            generator_code_hash(G)))
+    if not os.path.isfile(filename):
+        t0 = time.time()
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        x = G.windows(mode, filename=tmp)
+        x.flush()
+        del x
+        os.replace(tmp, filename)
+        if verbose > 0:
+            print("time = %.2fs, %s samples cached in '%s'" % (time.time() - t0, mode, filename))
+    _WINDOWS[(key, mode)] = np.load(filename, mmap_mode='r')
+    return _WINDOWS[(key, mode)]
     
     
 class ModelRunner(object):
@@ -52,6 +166,32 @@ class ModelRunner(object):
         self.hdf5_dir = os.path.join(WDIR, hdf5_dir)
         if hdf5_dir not in os.listdir(WDIR):
             os.mkdir(self.hdf5_dir)
+        self.published = []
+        
+    def publish(self, verbose=1):
+        """
+        Function that builds the generators for all settings of the grid 
+        search once and publishes them in shared memory (see nnts.shared).
+        Models constructed afterwards, in this or other processes, attach to 
+        the published data instead of loading and preprocessing it again.
+        """
+        for params in self.param_list:
+            for data in self.data_list:
+                generator_class = get_generator_class(data)
+                key = data_fingerprint(generator_class, data, params)
+                if (key in self.published) or shared.is_published(key):
+                    continue
+                shared.publish(generator_class(data, **params), key, verbose=verbose)
+                self.published.append(key)
+                
+    def release(self):
+        """
+        Function that drops the references to the generators published by 
+        self.publish; shared memory is freed once no worker uses them.
+        """
+        for key in self.published:
+            shared.release(key)
+        self.published = []
         
     def _read_results(self):
         if self.save_file.split(SEP)[-1] in os.listdir(SEP.join(self.save_file.split(SEP)[:-1])):
@@ -134,6 +274,10 @@ class ModelRunner(object):
                     hdf5_name = self._get_hdf5_name()
                     print('setting time %.2f' % (time.time() - setting_time))
                     nn.save(hdf5_name)
+                    prep_name = None
+                    if getattr(model.G, 'means', None) is not None:
+                        prep_name = hdf5_name[:-3] + '.prep'
+                        model.G.preprocessor().save(prep_name)
                     model_results.update(
                         {'training_time': time.time() - setting_time,
                          'datetime': datetime.datetime.now().isoformat(),
@@ -141,6 +285,7 @@ class ModelRunner(object):
                          'date': datetime.date.today().isoformat(),
                          'data': data,
                          'hdf5': hdf5_name,
+                         'prep': prep_name,
                          'total_params': np.sum([np.sum([np.prod(K.eval(w).shape) for w in l.trainable_weights]) for l in nn.layers])
 #                             'json': nn.to_json(),
 #                             'model_params': reducer.saved_layers
@@ -219,19 +364,18 @@ class Model(object):
         self.datasource = datasource
         self.tensorboard_dir = tensorboard_dir
         self.tb_val_limit = tb_val_limit
-        try:
-            generator_class = get_generator(datasource)
-        except:
-            generator_class = UserGenerator
-            
-        self.G = generator_class(datasource, **params)
+        generator_class = get_generator_class(datasource)
+        self.fingerprint = data_fingerprint(generator_class, datasource, params)
+        self.G = shared.attach(self.fingerprint)
+        if self.G is None:
+            self.G = generator_class(datasource, **params)
         self.idim, self.odim = self.G.get_dims(cols=self.target_cols)   
         self.nn, self.io_func, self.callbacks = self.build()
         
     def _set_params(self, params):
         self.train_share = (.8, 1)      # default delimeters of the training and validation shares
         self.input_length = 60          # default input length 
-        self.output_length = 1          # default no. of timesteps to predict (only 1 impelemented)
+        self.output_length = 1          # default no. of timesteps to predict (only 1 implemented for stateful LSTM)
         self.verbose = 1                # default verbosity
         self.batch_size = 128           # default batch size
         self.diffs = False              # if yes, work on 1st difference of series instead of original
@@ -239,6 +383,8 @@ class Model(object):
         self.patience = 5               # default no. of epoch after which learning rate will decrease if no improvement
         self.reduce_nb = 2              # defualt no. of learning rate reductions
         self.shuffle = True             # default wheather to shuffle batches during training
+        self.batch_buffers = 12         # no. of reused batch arrays; has to exceed the fit_generator queue size
+        self.eval_batch_size = 1024     # batch size for validation and test evaluation (if shuffle)
         if 'target_column_names' in params:
             params['target_cols'] = params['target_column_names']        
         self.__dict__.update(params)
@@ -272,26 +418,54 @@ class Model(object):
         tensorboard = keras_utils.TensorBoard(
             log_dir=tb_dir, histogram_freq=1, write_images=True
         )
+        # validation and test samples are evaluated from the cached arrays, 
+        # except for models trained on ordered batches (stateful LSTM)
+        callbacks = list(self.callbacks)
+        validation_size = self.G.n_valid - self.G.n_train - self.G.l
+        if self.shuffle:
+            valid = cached_windows(self.G, 'valid', self.fingerprint, self.verbose)
+            X, y = self.io_func(valid)
+            callbacks.insert(0, keras_utils.Validate(X, y, self.eval_batch_size, 
+                                                     self.verbose))
+            validation_data, validation_steps = None, None
+        else:
+            validation_data = self.G.gen('valid', func=self.io_func, shuffle=self.shuffle,
+                                         buffers=self.batch_buffers)
+            validation_steps = validation_size // self.batch_size
         if self.G.test:
-            test_cb = keras_utils.Test(self.G, self.io_func, self.verbose)
-            self.callbacks.append(test_cb)
+            if self.shuffle:
+                test_cb = keras_utils.Test(
+                    self.G, self.io_func, self.verbose, 
+                    windows=cached_windows(self.G, 'test', self.fingerprint, self.verbose),
+                    batch_size=self.eval_batch_size
+                )
+            else:
+                test_cb = keras_utils.Test(self.G, self.io_func, self.verbose)
+            callbacks.append(test_cb)
         
-        validation_size = self.G.n_valid - self.G.n_train - self.G.l
-        self.tb_gen = self.G.gen('valid', func=self.io_func, shuffle=self.shuffle,
-                            batch_size=min(validation_size, self.tb_val_limit))
         hist = self.nn.fit_generator(
-            self.G.gen('train', func=self.io_func, shuffle=self.shuffle),
+            self.G.gen('train', func=self.io_func, shuffle=self.shuffle,
+                       buffers=self.batch_buffers),
             steps_per_epoch = (self.G.n_train - self.G.l) // self.batch_size,
             epochs=1000,
-            callbacks=self.callbacks + [tensorboard],
-            validation_data=self.G.gen('valid', func=self.io_func, shuffle=self.shuffle),
-            validation_steps=validation_size // self.batch_size,
+            callbacks=callbacks + [tensorboard],
+            validation_data=validation_data,
+            validation_steps=validation_steps,
             verbose=self.verbose
         )
         history = hist.history
         if self.G.test:
             history.update(test_cb.test_hist)
         return history, self.nn#, reducer        
+
+    def backtest(self, **kwargs):
+        """
+        Function that computes the rolling forecasts of the trained network 
+        over a range of the series; see nnts.backtest.backtest for the 
+        arguments and returned values.
+        """
+        kwargs.setdefault('predict_batch_size', self.eval_batch_size)
+        return backtest.backtest(self.nn, self.G, self.io_func, cols=self.target_cols, **kwargs)
         
         
 class Generator(object):
@@ -325,23 +499,39 @@ class Generator(object):
         self.l = input_length + output_length
         self.verbose = verbose
         self.batch_size = batch_size
-        self.n_train = int(((self.X.shape[0] - diffs) * train_share[0] - self.l)/batch_size) * batch_size + self.l
-        self.n_valid = self.n_train + int(((self.X.shape[0] - diffs) * train_share[1] - self.n_train - self.l)/batch_size) * batch_size + self.l
-        if len(train_share) > 2:
-            self.n_test = self.n_valid + int(((self.X.shape[0] - diffs) * train_share[2] - self.n_valid - self.l)/batch_size) * batch_size + self.l
-            self.test = True
-        else:
-            self.test = False
+        self._set_limits(self.X.shape[0] - diffs)
         self.excluded = excluded
         self.cols = [c for c in self.X.columns if c not in self.excluded]
         self._scale(exclude_diff=exclude_diff)
         self.X.reset_index(drop=True, inplace=True)
     
+    def _set_limits(self, n):
+        """
+        Sets the ends of training, validation and test shares (n_train, 
+        n_valid, n_test) for a series of length n.
+        """
+        train_share, batch_size = self.train_share, self.batch_size
+        self.n_train = int((n * train_share[0] - self.l)/batch_size) * batch_size + self.l
+        self.n_valid = self.n_train + int((n * train_share[1] - self.n_train - self.l)/batch_size) * batch_size + self.l
+        if len(train_share) > 2:
+            self.n_test = self.n_valid + int((n * train_share[2] - self.n_valid - self.l)/batch_size) * batch_size + self.l
+            self.test = True
+        else:
+            self.test = False
+    
     def asarray(self, cols=None):
         if cols is None:
             cols = self.cols
         return np.asarray(self.X[cols], dtype=np.float32)
 
+    def preprocessor(self):
+        """
+        Returns nnts.preprocessing.Preprocessor that transforms new raw rows
+        (columns as of X) as X was transformed, continuing from the end of the
+        series.
+        """
+        return preprocessing.Preprocessor.from_generator(self)
+
     def get_target_col_ids(self, cols, ids=True):
         if cols in ['default', 'all']:
             if ids:
@@ -367,23 +557,148 @@ class Generator(object):
     def exclude_columns(self, cols):
         self.excluded += cols
         
-    def _scale(self, exclude=None, exclude_diff=None):
+    def _scale(self, exclude=None, exclude_diff=None, block=65536):
+        """
+        Function that replaces the non-excluded columns of X with a single 
+        float32 array, takes the 1st differences (if self.diffs) and 
+        normalizes it with the training share means and stds, all in place.
+        Excluded columns are kept (and differenced, unless in exclude_diff) 
+        at their original positions. The first raw values of the differenced
+        columns are kept in self.diff_base (NaN for the other columns), so 
+        that the levels can be restored.
+        Arguments:
+            exclude     - columns that are not normalized (default: 
+                          self.excluded)
+            exclude_diff - columns that are not differenced
+            block       - no. of rows processed at once by in place operations
+        """
         if exclude is None:
             exclude = self.excluded
-        cols = [c for c in self.X.columns if c not in exclude]
+        if exclude_diff is None:
+            exclude_diff = []
+        X = self.X
+        cols = [c for c in X.columns if c not in exclude]
+        arr = np.empty((X.shape[0], len(cols)), dtype=np.float32)
+        for k, c in enumerate(cols):
+            arr[:, k] = X[c].values
+        index, start = X.index, 0
+        self.diff_base = None
         if self.diffs:
-            diff_cols = [c for c in self.X.columns if c not in exclude_diff]
-            self.X.loc[:, diff_cols] = self.X.loc[:, diff_cols].diff()
-            self.X = self.X.loc[self.X.index[1:]]
-        self.means = self.X.loc[:self.n_train, cols].mean(axis=0)
-        self.stds = self.X.loc[:self.n_train, cols].std(axis=0)
-        self.X.loc[:, cols] = (self.X[cols] - self.means)/(self.stds + (self.stds == 0)*.001)
+            dids = [k for k, c in enumerate(cols) if c not in exclude_diff]
+            self.diff_base = pd.Series(np.nan, index=cols)
+            self.diff_base.iloc[dids] = arr[0, dids]
+            dids = slice(None) if (len(dids) == len(cols)) else np.asarray(dids, dtype=int)
+            for end in range(arr.shape[0], 1, -block):
+                b = max(1, end - block)
+                arr[b: end, dids] -= arr[b - 1: end - 1, dids]
+            arr, index, start = arr[1:], index[1:], 1
+        # rows labelled up to n_train, as in X.loc[:n_train]
+        n_train = index.slice_locs(None, self.n_train)[1]
+        moments = RunningMoments(len(cols))
+        for b in range(0, n_train, block):
+            moments.update(arr[b: min(b + block, n_train)])
+        self.means = pd.Series(moments.mean, index=cols)
+        self.stds = pd.Series(moments.std(ddof=1), index=cols)
+        arr -= np.asarray(self.means, dtype=np.float32)
+        arr /= np.asarray(self.stds + (self.stds == 0)*.001, dtype=np.float32)
+        self.X = pd.DataFrame(arr, columns=cols, index=index, copy=False)
+        for k, c in enumerate(X.columns):
+            if c in cols:
+                continue
+            if self.diffs and (c not in exclude_diff):
+                self.X.insert(k, c, X[c].diff().values[start:])
+            else:
+                self.X.insert(k, c, X[c].values[start:])
 
     def _get_ith_sample(self, i):
         return np.asarray(self.X.loc[i - self.input_length: i + self.output_length - 1, self.cols], dtype=np.float32)
+
+    def _get_batch(self, idx, offsets=None, out=None):
+        """
+        Function that returns the batch of samples ending at indices 'idx'.
+        Generators with array-based storage may override it to materialize
+        the whole batch at once.
+        Arguments:
+            idx         - (numpy.array) of sample indices
+            offsets     - if not None, (numpy.array) of timesteps (counted 
+                          from the start of the sample) to be returned
+            out         - if not None, preallocated array the batch is 
+                          written to
+        Returns
+            numpy.array of shape (len(idx), sample length, sample dimension)
+            or (len(idx), len(offsets), sample dimension)
+        """
+        if out is None:
+            x = np.array([self._get_ith_sample(i) for i in idx])
+            return x if (offsets is None) else x[:, offsets]
+        for k, i in enumerate(idx):
+            out[k] = self._get_ith_sample(i) if (offsets is None) else self._get_ith_sample(i)[offsets]
+        return out
+
+    def indices(self, mode):
+        """
+        Returns
+            numpy.array of indices of all samples in the 'train', 'valid' or
+            'test' share, in order
+        """
+        if mode in ['train', 'valid']:
+            order = np.arange(
+                self.input_length, self.n_valid - self.output_length
+            )
+            o_len = int(len(order) * self.train_share[0] / self.train_share[1])
+            return order[:o_len] if (mode == 'train') else order[o_len:]
+        elif mode == 'test':
+            assert self.test, "Test sample undefinded. To enable 'test' mode define three delimiters for train_share."
+            return np.arange(self.n_valid + self.input_length, 
+                             self.n_test - self.output_length)
+        raise Exception('invalid mode')
         
+    def batches(self, mode, func=None, batch_size=None):
+        """
+        Function that yields all samples of the 'train', 'valid' or 'test' 
+        share once, in order, in batches (the last one possibly smaller).
+        Arguments:
+            mode        - 'train', 'valid' or 'test'
+            func        - function applied to each batch, as in gen
+            batch_size  - if None, self.batch_size is used
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        if func is None:
+            func = lambda x: x
+        offsets = getattr(func, 'offsets', None)
+        idx = self.indices(mode)
+        for b in range(0, len(idx), batch_size):
+            x = self._get_batch(idx[b: b + batch_size], offsets=offsets)
+            yield func(x) if (offsets is None) else func(x, gathered=True)
+        
+    def windows(self, mode, filename=None, batch_size=1024):
+        """
+        Function that materializes all samples of the given share in order.
+        Arguments:
+            mode        - 'train', 'valid' or 'test'
+            filename    - if not None, samples are written to a .npy file of 
+                          that name, which is returned memory-mapped
+            batch_size  - no. of samples built at once
+        Returns
+            numpy.array of shape (no. of samples, sample length, sample dimension)
+        """
+        idx = self.indices(mode)
+        x = self._get_batch(idx[:batch_size])
+        shape = (len(idx),) + x.shape[1:]
+        if filename is None:
+            out = np.empty(shape, dtype=x.dtype)
+        else:
+            out = np.lib.format.open_memmap(filename, mode='w+', dtype=x.dtype, 
+                                            shape=shape)
+        out[:len(x)] = x
+        for b in range(batch_size, len(idx), batch_size):
+            self._get_batch(idx[b: b + batch_size], out=out[b: b + batch_size])
+        return out
+
     def gen(self, mode='train', batch_size=None, func=None, shuffle=True, 
-            n_start=0, n_end=np.inf):
+            n_start=0, n_end=np.inf, buffers=0, block_size=None, 
+            block_window=None):
         """
         Function that yields possibly infinitely many training/validation 
         samples.
@@ -398,9 +713,24 @@ class Generator(object):
                           default: 
                               lambda x: (x[:, :self.input_length, :], 
                                          x[:, self.input_length:, :])
-            shuffle     - wheather or not to shuffle samples every training epoch
+                          if func has an 'offsets' attribute, only these 
+                          timesteps of each sample are gathered and passed,
+                          with the keyword argument gathered=True
+            shuffle     - wheather or not to shuffle samples every training epoch;
+                          if 'block', the order is shuffled at block 
+                          granularity (see block_order), which keeps the 
+                          accesses local for memory mapped or paged data
             n_start, n_end - lower and upper limits of timesteps to appear in 
                              the generated samples. Irrelevant if mode != 'manual
+            buffers     - if > 0, batches are written into a ring of that many 
+                          preallocated arrays; a yielded batch (and any view 
+                          of it returned by func) is overwritten 'buffers' 
+                          batches later, so buffers has to exceed the number
+                          of batches the consumer holds at once
+            block_size, block_window - parameters of block_order for 
+                          shuffle='block' (default: generator's block_size 
+                          and block_window attributes if defined, else 
+                          16*batch_size and 4)
         Yields
             sequence of samples func(x) where x is a numpy.array of consecutive 
             rows of X
@@ -411,16 +741,8 @@ class Generator(object):
             batch_size = self.batch_size
         if func is None:
             func = lambda x: (x[:, :self.input_length, :], x[:, self.input_length:, :])
-        if mode in ['train', 'valid']:
-            order = np.arange(
-                self.input_length, self.n_valid - self.output_length
-            )
-            o_len = int(len(order) * self.train_share[0] / self.train_share[1])
-            order = order[:o_len] if (mode == 'train') else order[o_len:]
-        elif mode == 'test':
-            assert self.test, "Test sample undefinded. To enable 'test' mode define three delimiters for train_share."
-            order = np.arange(self.n_valid + self.input_length, 
-                              self.n_test - self.output_length)
+        if mode in ['train', 'valid', 'test']:
+            order = self.indices(mode)
         elif mode == 'manual':
             assert n_end < self.n_valid
             assert n_start >= 0
@@ -435,17 +757,38 @@ class Generator(object):
                 n_start -= self.l - 1
                 n_end -= self.l - 1
             order = np.arange(n_start + self.input_length, n_end - self.output_length)
-        x = []
+        if shuffle == 'block':
+            base = order
+            if block_size is None:
+                block_size = getattr(self, 'block_size', 16 * batch_size)
+            if block_window is None:
+                block_window = getattr(self, 'block_window', 4)
+        offsets = getattr(func, 'offsets', None)
+        ring, n_batch = [], 0
+        idx = []
         while True:
-            if shuffle:
+            if shuffle == 'block':
+                order = block_order(base, block_size, block_window)
+                if (n_batch == 0) and (self.verbose > 0):
+                    print('block shuffling: mean jump = %.3f of that of a full shuffle' 
+                          % shuffle_distance(order))
+            elif shuffle:
                 order = np.random.permutation(order)
             else:
                 order = order.reshape(batch_size, len(order)//batch_size).transpose().ravel()
             for i in order:
-                if len(x) == batch_size:
-                    yield func(np.array(x))
-                    x = []
-                x.append(self._get_ith_sample(i))
+                if len(idx) == batch_size:
+                    if 0 < buffers == len(ring):
+                        x = self._get_batch(np.array(idx), offsets=offsets, 
+                                            out=ring[n_batch % buffers])
+                    else:
+                        x = self._get_batch(np.array(idx), offsets=offsets)
+                        if buffers > 0:
+                            ring.append(x)
+                    n_batch += 1
+                    yield func(x) if (offsets is None) else func(x, gathered=True)
+                    idx = []
+                idx.append(i)
     
     def make_io_func(self, io_form, cols, input_cols=None):
         """
@@ -457,7 +800,9 @@ class Generator(object):
                                    dimension, only batch x sample_size)
                                    appropriate for Linear Regression
                 'regression':      returns tuple (3d np.array, 2d np.array)
-                                   first array formatted for LSTM and CNN nets
+                                   first array formatted for LSTM and CNN nets,
+                                   second - targets of all output_length
+                                   steps, flattened
                 'vi_regression':   format for SOCNN network wihtout auxiliary
                                    output
                 'cvi_regression':  format for SOCNN network with auxiliary
@@ -472,7 +817,8 @@ class Generator(object):
             model)
                           
         """
-        cols = self.get_target_col_ids(cols=cols)
+        cols = as_slice(self.get_target_col_ids(cols=cols))
+        input_cols = as_slice(input_cols)
         il = self.input_length
         if io_form == 'stateful_lstm_regression':
             def regr(x):
@@ -482,22 +828,15 @@ class Generator(object):
             return regr
         elif io_form == 'regression':
             def regr(x):
-                osh = (x.shape[0], (x.shape[1] - il) * len(cols))
                 return (x[:, :il, :] if (input_cols is None) else x[:, :il, input_cols], 
-                        x[:, il:, cols].reshape(osh))
+                        x[:, il:, cols].reshape(x.shape[0], -1))
             return regr            
         
         elif io_form == 'flat_regression':
             def regr(x):
-                if input_cols is None:
-                    ish = (x.shape[0], il * x.shape[2])
-                    inp =  x[:, :il, :]
-                else:
-                    ish = (x.shape[0], il * len(input_cols))
-                    inp = x[:, :il, input_cols]
-                osh = (x.shape[0], (x.shape[1] - il) * len(cols))              
-                return (inp.reshape(ish), 
-                        x[:, il:, cols].reshape(osh))
+                inp = x[:, :il, :] if (input_cols is None) else x[:, :il, input_cols]
+                return (inp.reshape(x.shape[0], -1), 
+                        x[:, il:, cols].reshape(x.shape[0], -1))
             return regr
     
         elif io_form == 'vi_regression':
@@ -511,11 +850,12 @@ class Generator(object):
         elif io_form == 'cvi_regression':
             def regr(x):
         #        osh = (x.shape[0], (x.shape[1] - il) * len(cols))
+                v = x[:, il: il+1, cols]
                 return (
                     {'inp': x[:, :il, :] if (input_cols is None) else x[:, :il, input_cols], 
                      'value_input': x[:, :il, cols]},
                     {'main_output': x[:, il:, cols],
-                     'value_output': np.concatenate(il*[x[:, il: il+1, cols]], axis=1)}
+                     'value_output': np.broadcast_to(v, (v.shape[0], il, v.shape[2]))}
                 )           
             return regr
             
@@ -555,13 +895,26 @@ class UserGenerator(Generator):
         verbose         - level of verbosity (corresponds to keras use of 
                           verbose argument)
         limit           - maximum number of timesteps-rows in the input DataFrame
+        chunksize       - if not None, the csv file is read in chunks of that 
+                          many rows and the preprocessed (differenced and 
+                          normalized) columns are written to a float32 .npy 
+                          store, which backs X as a memory map; X, cols and 
+                          diffs are as without chunksize (all columns have to
+                          be numeric)
+        store           - path of the store (default: data path with .npy 
+                          extension)
     """
     def __init__(self, data, input_column_names=None, target_column_names=None,
                  diff_column_names=[],
                  train_share=(.8, 1), input_length=1, output_length=1,
-                 verbose=1, batch_size=128, limit=np.inf, **kwargs):
-        DataFrame = pd.read_csv(data)
-        cols = list(DataFrame.columns)
+                 verbose=1, batch_size=128, limit=np.inf, chunksize=None, 
+                 store=None, **kwargs):
+        self.streaming = chunksize is not None
+        if self.streaming:
+            cols = list(pd.read_csv(data, nrows=0).columns)
+        else:
+            DataFrame = pd.read_csv(data)
+            cols = list(DataFrame.columns)
         if input_column_names is None:
             input_column_names = cols
             if verbose > 0:
@@ -579,6 +932,15 @@ class UserGenerator(Generator):
             exclude_diff = []
         
         excluded = [c for c in cols if c not in input_column_names]
+        if self.streaming:
+            self.train_share = train_share
+            self.l = input_length + output_length
+            self.batch_size = batch_size
+            if store is None:
+                store = os.path.splitext(data)[0] + '.npy'
+            DataFrame = self._stream(data, store, cols, excluded, exclude_diff, diffs, 
+                                     chunksize, limit, verbose)
+            limit = np.inf
         
         super(UserGenerator, self).__init__(
             X=DataFrame, 
@@ -589,9 +951,81 @@ class UserGenerator(Generator):
             limit=limit,
             batch_size=batch_size,
             excluded=excluded,
-            diffs=diffs,
+            # the store is already differenced (and its length set accordingly)
+            diffs=diffs and not self.streaming,
             exclude_diff=exclude_diff
         )
+        self.diffs = diffs
+        
+    def _stream(self, data, store, cols, excluded, exclude_diff, diffs, chunksize, 
+                limit, verbose):
+        """
+        Function that reads columns 'cols' of the csv file 'data' in chunks, 
+        takes the 1st differences (also across chunk boundaries), accumulates
+        the training share means and stds of the columns not in 'excluded' 
+        and writes the float32 series, normalized but for the excluded 
+        columns (as Generator._scale does), to the .npy file 'store'.
+        Returns
+            pandas.DataFrame backed by the memory mapped store
+        """
+        t0 = time.time()
+        sample = pd.read_csv(data, usecols=cols, nrows=chunksize)
+        text = [c for c in cols if sample[c].dtype.kind not in 'biuf']
+        if len(text) > 0:
+            raise ValueError('streaming (chunksize) stores float32 columns; non-numeric columns %s '
+                             'are not supported' % repr(text))
+        n = 0
+        for chunk in pd.read_csv(data, usecols=cols[:1], chunksize=chunksize):
+            n += chunk.shape[0]
+        n = int(min(n, limit + 1)) - diffs
+        self._set_limits(n)
+        if verbose > 0:
+            print('time = %.2fs, %d rows counted in %s' % (time.time() - t0, n + diffs, data))
+        dids = [k for k, c in enumerate(cols) if c not in exclude_diff]
+        norm = [c for c in cols if c not in excluded]
+        nids = [cols.index(c) for c in norm]
+        nids = slice(None) if (len(nids) == len(cols)) else np.asarray(nids, dtype=int)
+        out = np.lib.format.open_memmap(store, mode='w+', dtype=np.float32, 
+                                        shape=(n, len(cols)))
+        # rows labelled up to n_train, as in X.loc[:n_train]
+        n_stat = self.n_train + 1 - diffs
+        moments = RunningMoments(len(norm))
+        pos, prev = 0, None
+        self.diff_base = None
+        for chunk in pd.read_csv(data, usecols=cols, chunksize=chunksize):
+            arr = np.asarray(chunk[cols], dtype=np.float32)
+            if diffs:
+                last = arr[-1].copy()
+                arr[1:, dids] -= arr[:-1, dids]
+                if prev is None:
+                    self.diff_base = pd.Series(np.nan, index=norm)
+                    for c in norm:
+                        if c not in exclude_diff:
+                            self.diff_base[c] = arr[0, cols.index(c)]
+                    arr = arr[1:]
+                else:
+                    arr[0, dids] -= prev[dids]
+                prev = last
+            arr = arr[:n - pos]
+            out[pos: pos + arr.shape[0]] = arr
+            moments.update(arr[:max(0, n_stat - pos), nids])
+            pos += arr.shape[0]
+            if pos >= n:
+                break
+        self.means = pd.Series(moments.mean, index=norm)
+        self.stds = pd.Series(moments.std(ddof=1), index=norm)
+        means = np.asarray(self.means, dtype=np.float32)
+        stds = np.asarray(self.stds + (self.stds == 0)*.001, dtype=np.float32)
+        for b in range(0, n, chunksize):
+            out[b: b + chunksize, nids] = (out[b: b + chunksize, nids] - means) / stds
+        out.flush()
+        if verbose > 0:
+            print("time = %.2fs, normalized series written to '%s'" % (time.time() - t0, store))
+        return pd.DataFrame(out, columns=cols, copy=False)
+    
+    def _scale(self, **kwargs):
+        if not self.streaming:
+            super(UserGenerator, self)._scale(**kwargs)
         
     def get_target_col_ids(self, cols, ids=True):
         if cols in ['default', 'all']:
@@ -607,6 +1041,41 @@ class UserGenerator(Generator):
         raise Exception("'cols' must be iterable contatining column names or numbers. Got" + repr(cols) + ".")
             
             
+class RunningMoments(object):
+    """
+    Class that accumulates means and variances of data streamed in chunks, 
+    using the pairwise update of (count, mean, sum of squared deviations), 
+    which is numerically stable for long series.
+    Initialization arguments:
+        shape       - shape of the statistics, () for a single value or 
+                      (no. of columns,) for column-wise statistics
+    """
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.M2 = np.zeros(shape)
+        
+    def update(self, x):
+        """
+        Arguments:
+            x           - (numpy.array) chunk of data; rows along the first axis
+        """
+        x = np.asarray(x, dtype=np.float64)
+        n = x.shape[0]
+        if n == 0:
+            return
+        mean = x.mean(axis=0)
+        M2 = ((x - mean)**2).sum(axis=0)
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean = self.mean + delta * n / total
+        self.M2 = self.M2 + M2 + delta**2 * self.n * n / total
+        self.n = total
+        
+    def std(self, ddof=0):
+        return np.sqrt(self.M2 / max(self.n - ddof, 1))
+        
+    
 def parse(argv):
     dataset = []
     data_files = os.listdir(os.path.join(WDIR, 'data'))
@@ -665,6 +1134,17 @@ def parse(argv):
     return dataset, save_file
 
     
+def get_generator_class(datasource):
+    """
+    Returns the generator class for 'datasource': the one given by 
+    get_generator or UserGenerator.
+    """
+    try:
+        return get_generator(datasource)
+    except:
+        return UserGenerator
+    
+    
 def get_generator(dataset):
     if 'async' in dataset:
         from .household import HouseholdAsynchronousGenerator as generator
@@ -673,7 +1153,10 @@ def get_generator(dataset):
     elif 'artificial' in dataset:
         from .artificial import ArtificialGenerator as generator  
     elif 'lobster' in dataset:
-        from .lobster import LOBSTERGenerator as generator
+        if os.path.isfile(os.path.join(WDIR, dataset, 'index.pkl')):
+            from .lobster import LOBSTERDaysGenerator as generator
+        else:
+            from .lobster import LOBSTERGenerator as generator
     elif 'book' in dataset:
         from .book import BookGenerator as generator
     else:
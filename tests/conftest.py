@@ -0,0 +1,117 @@
+"""
+Shared fixtures of the tests.
+"""
+import importlib.util
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture(scope='session')
+def inference():
+    """
+    nnts.inference loaded from its file, without importing the package (and
+    keras): the module depends on numpy only.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nnts', 'inference.py')
+    spec = importlib.util.spec_from_file_location('nnts_inference', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _conv(rs, cin, cout, k, acts, dilation=1):
+    return {'type': 'conv', 'kernel': (rs.randn(k, cin, cout) * .3).astype(np.float32),
+            'bias': (rs.randn(cout) * .1).astype(np.float32),
+            'pad': [(k - 1) * dilation // 2, (k - 1) * dilation - (k - 1) * dilation // 2],
+            'dilation': dilation, 'acts': acts}
+
+
+@pytest.fixture
+def cnn_specs():
+    """
+    Specs (see nnts.inference.extract_specs) of a small CNN network with max
+    pooling, on windows of 32 rows of 4 columns.
+    """
+    rs = np.random.RandomState(0)
+    chain = [_conv(rs, 4, 8, 3, [['leakyrelu', .1]]), _conv(rs, 8, 8, 3, [['leakyrelu', .1]], dilation=2),
+             {'type': 'pool', 'size': 2, 'acts': []}, _conv(rs, 8, 6, 3, [['relu', 0.]])]
+    return {'kind': 'cnn', 'input_length': 32, 'chain': chain,
+            'dense': {'kernel': (rs.randn(16 * 6, 2) * .1).astype(np.float32),
+                      'bias': np.zeros(2, dtype=np.float32), 'acts': []}}
+
+
+@pytest.fixture
+def socnn_specs():
+    """
+    Specs of a small SOCNN network forecasting columns 0 and 1 of windows of
+    16 rows of 4 columns, 'steps' steps ahead (make(steps)).
+    """
+    def make(steps=1):
+        rs = np.random.RandomState(1)
+        return {'kind': 'socnn', 'input_length': 16, 'weighting': 'softmax', 'value_cols': [0, 1],
+                'sigs': [_conv(rs, 4, 8, 3, [['leakyrelu', .1]]), _conv(rs, 8, 2, 3, [])],
+                'offs': [_conv(rs, 4, 8, 1, [['leakyrelu', .1]]), _conv(rs, 8, 2, 1, [])],
+                'out': {'kernel': (rs.rand(2, 16, steps) * .2).astype(np.float32),
+                        'bias': np.zeros((2, steps), dtype=np.float32)}}
+    return make
+
+
+@pytest.fixture
+def lstm_specs():
+    """
+    Specs of a small stateful LSTM network with 4 input columns, 8 units and
+    2 outputs.
+    """
+    rs = np.random.RandomState(2)
+    return {'kind': 'lstm', 'input_length': 1,
+            'lstm': {'kernel': (rs.randn(4, 32) * .3).astype(np.float32),
+                     'recurrent_kernel': (rs.randn(8, 32) * .3).astype(np.float32),
+                     'bias': (rs.randn(32) * .1).astype(np.float32),
+                     'activation': 'tanh', 'recurrent_activation': 'hard_sigmoid'},
+            'acts': [['leakyrelu', .1]],
+            'dense': {'kernel': (rs.randn(8, 2) * .3).astype(np.float32),
+                      'bias': np.zeros(2, dtype=np.float32), 'acts': []}}
+
+
+@pytest.fixture
+def household_file(tmp_path):
+    """
+    Absolute path of a synthetic household series (as read by
+    nnts.household.HouseholdAsynchronousGenerator) of 3000 minutes.
+    """
+    rs = np.random.RandomState(1)
+    n = 3000
+    X = pd.DataFrame({'datetime': pd.date_range('2007-01-01', periods=n, freq='min')})
+    for c in ['g1', 'g2', 'g3', 'g4', 'g5', 'g6', 'g7']:
+        X[c] = rs.rand(n).astype(np.float32) * 5
+    X['time'] = (np.arange(n) % 1440).astype(np.float32)
+    path = os.path.join(str(tmp_path), 'household.pkl')
+    X.to_pickle(path)
+    return path
+
+
+@pytest.fixture
+def lobster_dir(tmp_path):
+    """
+    Absolute path of a directory with a synthetic LOBSTER day of 600 events 
+    and 5 book levels (message.csv and orderbook.csv).
+    """
+    rs = np.random.RandomState(0)
+    n, levels = 600, 5
+    directory = os.path.join(str(tmp_path), 'lobster_5')
+    os.makedirs(directory)
+    t = 34200 + np.cumsum(rs.exponential(.004, n))
+    t[50:53] = t[50]
+    bid = 5000000 + 100 * np.cumsum(rs.choice([-1, 0, 0, 0, 1], n))
+    ask = bid + 100 * rs.choice([1, 2], n)
+    book = np.concatenate([np.c_[ask + 100 * j, rs.randint(1, 500, n), bid - 100 * j, rs.randint(1, 500, n)]
+                           for j in range(levels)], axis=1)
+    np.savetxt(os.path.join(directory, 'orderbook.csv'), book, fmt='%d', delimiter=',')
+    lvl = rs.randint(0, levels, n)
+    price = np.where(rs.rand(n) > .5, ask + 100 * lvl, bid - 100 * lvl)
+    mess = pd.DataFrame({'Time': t, 'Type': rs.randint(1, 6, n), 'ID': np.arange(n), 
+                         'Size': rs.randint(1, 300, n), 'Price': price, 'Direction': rs.choice([-1, 1], n)})
+    mess.to_csv(os.path.join(directory, 'message.csv'), header=False, index=False, float_format='%.9f')
+    return directory
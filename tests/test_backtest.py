@@ -0,0 +1,59 @@
+"""
+Tests of nnts.backtest.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('keras')
+from nnts import backtest, utils
+
+
+class Oracle(object):
+    """
+    Network that predicts the true targets of the consecutive samples.
+    """
+    def __init__(self, targets):
+        self.targets, self.n = targets, 0
+
+    def predict(self, inp, batch_size=None):
+        y = self.targets[self.n: self.n + len(inp)]
+        self.n += len(inp)
+        return y
+
+
+@pytest.mark.parametrize('diffs', [False, True])
+def test_oracle_reconstructs_raw_series(diffs):
+    rs = np.random.RandomState(0)
+    n, il, ol = 3000, 20, 4
+    raw = pd.DataFrame({'a': np.cumsum(rs.randn(n)) + 100, 'b': rs.randn(n) * 3 + 7,
+                        'c': np.cumsum(rs.randn(n))})
+    G = utils.Generator(raw.copy(), train_share=(.6, .8, 1.), input_length=il, output_length=ol,
+                        diffs=diffs, exclude_diff=['b'], batch_size=32, verbose=0)
+    io = G.make_io_func('regression', cols=['a', 'b'])
+    idx = np.arange(il, len(G.X) - ol + 1, 3)
+    nn = Oracle(io(G._get_batch(idx))[1])
+    r = backtest.backtest(nn, G, io, cols=['a', 'b'], stride=3, batch_size=500, verbose=0)
+    assert (r['index'] == idx).all()
+    np.testing.assert_allclose(r['mse'], 0, atol=1e-8)
+    # series row j is raw row j + 1 after differencing
+    rows = idx[:, None] + int(diffs) + np.arange(ol)
+    np.testing.assert_allclose(r['predictions'][:, :, 0], raw['a'].values[rows], atol=1e-3)
+    np.testing.assert_allclose(r['predictions'][:, :, 1], raw['b'].values[rows], atol=1e-3)
+
+
+def test_oracle_household_events(household_file):
+    # the event-encoded generator keeps no dense X; the differenced forecasts
+    # are compared with those of the undifferenced generator (one row later)
+    from nnts.household import HouseholdAsynchronousGenerator
+    results = {}
+    for diffs in [False, True]:
+        np.random.seed(0)
+        G = HouseholdAsynchronousGenerator(household_file, input_length=5, output_length=2,
+                                           diffs=diffs, batch_size=8)
+        io = G.make_io_func('regression')
+        start, end = int(not diffs), 500 + int(not diffs)
+        nn = Oracle(io(G._get_batch(np.arange(start + 5, end - 1)))[1])
+        results[diffs] = backtest.backtest(nn, G, io, start=start, end=end, batch_size=100, verbose=0)
+        np.testing.assert_allclose(results[diffs]['mse'], 0, atol=1e-8)
+    np.testing.assert_allclose(results[True]['predictions'], results[False]['predictions'], atol=1e-3)
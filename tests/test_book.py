@@ -0,0 +1,37 @@
+"""
+Tests of nnts.book.BookGenerator.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('keras')
+from nnts.book import BookGenerator
+
+
+def make_book(path, n=600, seed=0):
+    rs = np.random.RandomState(seed)
+    mid = 1000 + np.cumsum(rs.randn(n))
+    book = pd.DataFrame({'best_ask': mid + 1 + rs.rand(n), 'best_bid': mid - 1 - rs.rand(n),
+                         'ask_1': rs.rand(n), 'bid_1': rs.rand(n), 'count_1': rs.poisson(3, n),
+                         'current_bid': mid - 1, 'current_ask': mid + 1,
+                         'seconds': np.cumsum(rs.exponential(1., n))})
+    book.to_pickle(path)
+    return path
+
+
+def test_exp_time_gathered_matches_full(tmp_path):
+    # output_length=4 gives as many target rows as output_length, so the
+    # gathered and the full windows have the same length
+    G = BookGenerator(make_book(os.path.join(str(tmp_path), 'book.pkl')), input_length=8, 
+                      output_length=4, batch_size=4, train_share=(.6, .8, 1.), verbose=0)
+    regr = G.make_io_func('0+exp_time')
+    assert len(regr.offsets) == G.l
+    idx = G.indices('valid')
+    full = regr(G._get_batch(idx))
+    gathered = regr(G._get_batch(idx, offsets=regr.offsets), gathered=True)
+    batched = next(G.batches('valid', func=regr, batch_size=len(idx)))
+    for a, b, c in zip(full, gathered, batched):
+        np.testing.assert_allclose(a, b)
+        np.testing.assert_allclose(a, c)
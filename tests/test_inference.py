@@ -0,0 +1,65 @@
+"""
+Tests of the numpy forward pass of nnts.inference against keras.
+"""
+import os
+import types
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from nnts import inference
+from nnts.models.LR import LRmodel
+from nnts.models.CNN import CNNmodel
+from nnts.models.SOCNN import SOCNNmodel
+
+TOLERANCE = 1e-4
+
+
+def build(model_class, **params):
+    """
+    Returns keras network built by model_class with 'params', with random
+    batch normalization statistics (so that their folding is exercised).
+    """
+    G = types.SimpleNamespace(make_io_func=lambda **kwargs: None)
+    defaults = dict(input_length=16, idim=4, odim=2, output_length=1, G=G, target_cols='default',
+                    lr=.01, clipnorm=1., norm=10, patience=5, reduce_nb=2, verbose=0)
+    nn = model_class.build(types.SimpleNamespace(**dict(defaults, **params)))[0]
+    rs = np.random.RandomState(0)
+    for l in nn.layers:
+        if l.__class__.__name__ == 'BatchNormalization':
+            gamma, beta, mean, var = l.get_weights()
+            l.set_weights([rs.rand(*gamma.shape) + .5, rs.randn(*beta.shape) * .1,
+                           rs.randn(*mean.shape) * .1, rs.rand(*var.shape) + .5])
+    return nn
+
+
+def check(nn, X, tmp_path):
+    assert inference.parity(nn, X) < TOLERANCE
+    path = os.path.join(str(tmp_path), 'nn.npz')
+    inference.export(nn, path)
+    x, v = inference._split_inputs(X)
+    y = inference.Predictor(inference.extract_specs(nn)).predict(x, value_input=v)
+    np.testing.assert_allclose(inference.load(path).predict(x, value_input=v), y, atol=TOLERANCE)
+
+
+def test_lr(tmp_path):
+    nn = build(LRmodel, solver='ridge')
+    check(nn, np.random.RandomState(1).randn(32, 16 * 4).astype(np.float32), tmp_path)
+
+
+@pytest.mark.parametrize('act', ['leakyrelu', 'relu'])
+def test_cnn(tmp_path, act):
+    nn = build(CNNmodel, layers_no=4, maxpooling=3, poolsize=2, dropout=0., kernelsize=[1, 3],
+               filters=8, act=act, resnet=False)
+    check(nn, np.random.RandomState(1).randn(32, 16, 4).astype(np.float32), tmp_path)
+
+
+@pytest.mark.parametrize('output_length', [1, 3])
+def test_socnn(tmp_path, output_length):
+    nn = build(SOCNNmodel, output_length=output_length, layers_no={'sigs': 3, 'offs': 2},
+               kernelsize=[1, 3], filters=8, act='leakyrelu', resnet=False, connection_freq=2,
+               architecture={'softmax': True, 'lambda': False}, shared_final_weights=False,
+               nonnegative=False, aux_weight=0.)
+    rs = np.random.RandomState(1)
+    X = [rs.randn(32, 16, 4).astype(np.float32), rs.randn(32, 16, 2).astype(np.float32)]
+    check(nn, X, tmp_path)
@@ -0,0 +1,45 @@
+"""
+Tests of nnts.lobster.
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from nnts.lobster import LOBSTERGenerator, LOBSTERDaysGenerator, ingest
+
+PARAMS = dict(keep_lvl=3, input_length=20, chunk=50, verbose=0)
+
+
+@pytest.mark.parametrize('change', [dict(limit=300), dict(input_length=10), dict(compact=True),
+                                    dict(keep_lvl=2), dict(_time=.02), dict(diffs=False)])
+def test_shards_reject_other_parameters(lobster_dir, tmp_path, change):
+    shards = os.path.join(str(tmp_path), 'shards')
+    G = LOBSTERGenerator(lobster_dir, **PARAMS)
+    G.materialize(shards, processes=1)
+    S = LOBSTERGenerator(lobster_dir, shards=shards, **PARAMS)
+    assert (S.n_train, S.n_valid) == (G.n_train, G.n_valid)
+    idx = S.indices('valid')[:8]
+    expected = np.array([G._get_ith_sample(i) for i in idx], dtype=np.float32)
+    np.testing.assert_allclose(S._get_batch(idx), expected, atol=1e-5)
+    with pytest.raises(ValueError):
+        LOBSTERGenerator(lobster_dir, shards=shards, **dict(PARAMS, **change))
+
+
+@pytest.mark.parametrize('_time', [.01, [.05, .2]])
+def test_compact_matches_grids(lobster_dir, _time):
+    # horizons long enough for the mid price to move by several ticks
+    G = LOBSTERGenerator(lobster_dir, _time=_time, **PARAMS)
+    C = LOBSTERGenerator(lobster_dir, _time=_time, compact=True, **PARAMS)
+    assert C.lossless and (C.events['band'].shape[1] > 2 * C.keep_lvl)
+    for i in range(G.input_length, G.max_end + 1):
+        np.testing.assert_allclose(C._get_ith_sample(i), np.array(G._get_ith_sample(i), dtype=np.float32),
+                                   atol=1e-5)
+
+
+def test_days_flag_clipped_bands(lobster_dir, tmp_path):
+    out = os.path.join(str(tmp_path), 'days')
+    for margin, lossless in [(0, False), (50, True)]:
+        ingest([lobster_dir], out, keep_lvl=3, margin=margin, verbose=0)
+        G = LOBSTERDaysGenerator(out, _time=.2, input_length=20, verbose=0)
+        assert G.lossless == lossless
@@ -0,0 +1,28 @@
+"""
+Tests of nnts.inference.LSTMSession.
+"""
+import numpy as np
+
+
+def test_snapshot_restore_matches_unbroken_run(inference, lstm_specs):
+    X = np.random.RandomState(4).randn(20, 3, 4).astype(np.float32)
+    ids = ['a', 'b', 'c']
+    unbroken = inference.LSTMSession(lstm_specs, capacity=2)
+    expected = [unbroken.step(ids, x) for x in X]
+    # the stateless predict gives the same outputs from zero states
+    np.testing.assert_allclose(inference.LSTMSession(lstm_specs).predict(np.swapaxes(X, 0, 1)),
+                               np.swapaxes(expected, 0, 1), atol=1e-6)
+    S = inference.LSTMSession(lstm_specs)
+    for x in X[:10]:
+        S.step(ids, x)
+    snapshot = S.snapshot()
+    S.drop(['b'])
+    S.step(['c', 'd'], X[10, 1:])
+    # restored in a fresh session, with the series in another order
+    R = inference.LSTMSession(lstm_specs)
+    R.step(['z'], X[0, :1])
+    R.restore(snapshot)
+    S.restore(snapshot)
+    for t in range(10, 20):
+        np.testing.assert_allclose(S.step(ids, X[t]), expected[t], atol=1e-6)
+        np.testing.assert_allclose(R.step(ids[::-1], X[t, ::-1]), expected[t][::-1], atol=1e-6)
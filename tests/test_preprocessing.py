@@ -0,0 +1,33 @@
+"""
+Tests of nnts.preprocessing.Preprocessor.
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from nnts.household import HouseholdAsynchronousGenerator
+from nnts.preprocessing import Preprocessor
+
+
+@pytest.mark.parametrize('diffs', [False, True])
+def test_household_async(tmp_path, household_file, diffs):
+    # the event-encoded generator keeps no dense X, the raw rows are G.cols
+    np.random.seed(0)
+    G = HouseholdAsynchronousGenerator(household_file, input_length=5, output_length=2, diffs=diffs,
+                                       batch_size=8)
+    P = G.preprocessor()
+    assert P.columns == G.cols
+    x = G.asarray()
+    stds = np.asarray(G.stds[G.cols]) + (np.asarray(G.stds[G.cols]) == 0)*.001
+    raw = x * stds + np.asarray(G.means[G.cols])
+    if diffs:
+        raw = np.asarray(G.diff_base[G.cols]) + np.cumsum(raw, axis=0)
+        np.testing.assert_allclose(P.last, raw[-1, P.dids], rtol=1e-4, atol=1e-3)
+        P.reset(raw[99])
+    else:
+        assert P.last is None
+    np.testing.assert_allclose(P.transform(raw[100: 110]), x[100: 110], atol=1e-3)
+    P.save(os.path.join(str(tmp_path), 'hh.prep'))
+    Q = Preprocessor.load(os.path.join(str(tmp_path), 'hh.prep'))
+    assert (Q.columns, Q.diff_cols) == (P.columns, P.diff_cols)
@@ -0,0 +1,20 @@
+"""
+Tests of the quantization of nnts.inference networks.
+"""
+import numpy as np
+
+
+def test_quantized_predictor_holds_only_quantized_weights(inference, cnn_specs):
+    X = np.random.RandomState(2).randn(300, 32, 4).astype(np.float32)
+    y = inference.Predictor(cnn_specs).predict(X[100:])
+    size = inference.nbytes(cnn_specs)
+    for mode, ratio in [('float16', .6), ('int8', .4)]:
+        P = inference.Predictor(inference.quantize(cnn_specs, mode, calibration=X[:100]))
+        held = [v for v in vars(P).values() if isinstance(v, np.ndarray)]
+        assert held == []
+        assert inference.nbytes(P.specs) < ratio * size
+        r = inference.quantization_report(cnn_specs, X[100:], calibration=X[:100], modes=(mode,),
+                                          repeat=1, verbose=0)
+        assert r[mode]['bytes'] == inference.nbytes(P.specs)
+        assert r['float32']['bytes'] == size
+        np.testing.assert_allclose(P.predict(X[100:]), y, atol=.05 * y.std())
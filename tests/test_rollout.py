@@ -0,0 +1,22 @@
+"""
+Tests of nnts.inference.rollout.
+"""
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('steps', [1, 3])
+def test_matches_repeated_predictions(inference, socnn_specs, steps):
+    P = inference.Predictor(socnn_specs(steps))
+    assert P.predict(np.zeros((16, 4), dtype=np.float32)).shape == (steps, 2)
+    x = np.random.RandomState(4).randn(6, 16, 4).astype(np.float32)
+    y = inference.rollout(P, x, 5)
+    assert y.shape == (6, 5, 2)
+    for window, forecast in zip(x, y):
+        for h in range(5):
+            # the first step of each forecast is fed back as the next row
+            step = P.predict(window)[0]
+            np.testing.assert_allclose(forecast[h], step, atol=1e-5)
+            row = window[-1].copy()
+            row[[0, 1]] = step
+            window = np.vstack([window[1:], row])
@@ -0,0 +1,109 @@
+"""
+Tests of nnts.serving with tiny exported (numpy) networks.
+"""
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('keras')
+from nnts import inference, serving
+
+
+def lr_specs(seed, n_inputs=8, n_outputs=2):
+    rs = np.random.RandomState(seed)
+    return {'kind': 'lr', 'input_length': n_inputs,
+            'dense': {'kernel': rs.randn(n_inputs, n_outputs).astype(np.float32),
+                      'bias': rs.randn(n_outputs).astype(np.float32), 'acts': []}}
+
+
+def make_registry(directory, keys, **kwargs):
+    rows = []
+    for i, key in enumerate(keys):
+        h5 = os.path.join(directory, '%06d_LR.h5' % i)
+        inference.save(lr_specs(i), h5[:-3] + '.npz')
+        rows.append({'data': key, 'val_loss': [1., .5], 'hdf5': h5})
+    pd.DataFrame(rows).to_pickle(os.path.join(directory, 'results.pkl'))
+    return serving.ModelRegistry(os.path.join(directory, 'results.pkl'), **kwargs)
+
+
+def test_batched_predictions_match_predictor(cnn_specs, tmp_path):
+    path = os.path.join(str(tmp_path), 'cnn.npz')
+    inference.save(cnn_specs, path)
+    P = inference.Predictor(cnn_specs)
+    X = np.random.RandomState(0).randn(40, 32, 4).astype(np.float32)
+    S = serving.ForecastService(path, max_batch=16, deadline=.05)
+    try:
+        futures = [S.submit(x) for x in X]
+        Y = np.array([f.result(timeout=10) for f in futures])
+        assert S.stats()['batches'] < len(X)
+        np.testing.assert_allclose(Y, P.predict(X), atol=1e-5)
+        server = serving.serve(S)
+        url = 'http://%s:%d' % server.server_address
+        np.testing.assert_allclose(serving._http_predict(url, X[0]), Y[0], atol=1e-5)
+        server.shutdown()
+    finally:
+        S.close()
+
+
+def test_registry_evicts_least_recently_used(tmp_path):
+    size = inference.nbytes(lr_specs(0))
+    R = make_registry(str(tmp_path), ['a', 'b', 'c'], max_bytes=2 * size, prefetch=0)
+    x = np.ones(8, dtype=np.float32)
+    for key in ['a', 'b', 'a', 'c']:
+        P = inference.Predictor(lr_specs('abc'.index(key)))
+        np.testing.assert_allclose(R.get(key).predict(x), P.predict(x), atol=1e-5)
+    # 'b' was the least recently used when 'c' was loaded
+    assert list(R.cache) == ['a', 'c']
+    assert R.stats()['evicted'] == 1
+    assert R.nbytes <= 2 * size
+    R.get('a')
+    assert (R.hits, R.misses) == (2, 3)
+
+
+def test_evicted_networks_are_closed(tmp_path):
+    R = make_registry(str(tmp_path), ['a', 'b'], max_bytes=1, prefetch=0)
+    closed = []
+    load = R._load
+
+    class Closable(object):
+        def __init__(self, model, key):
+            self.model, self.key, self.specs = model, key, model.specs
+
+        def close(self):
+            closed.append(self.key)
+
+    R._load = lambda key: Closable(load(key), key)
+    R.get('a')
+    R.get('b')
+    assert closed == ['a']
+
+
+def test_registry_miss_does_not_block_worker(tmp_path):
+    R = make_registry(str(tmp_path), ['slow', 'fast'], prefetch=0)
+    R.get('fast')
+    load, release = R._load, threading.Event()
+
+    def slow_load(key):
+        if key == 'slow':
+            release.wait(10)
+        return load(key)
+    R._load = slow_load
+    S = serving.ForecastService(R, deadline=.001)
+    try:
+        x = np.ones(8, dtype=np.float32)
+        slow = S.submit(x, key='slow')
+        fast = S.submit(x, key='fast')
+        # answered while 'slow' is still loading
+        np.testing.assert_allclose(fast.result(timeout=5), inference.Predictor(lr_specs(1)).predict(x),
+                                   atol=1e-5)
+        assert not slow.done()
+        release.set()
+        np.testing.assert_allclose(slow.result(timeout=5), inference.Predictor(lr_specs(0)).predict(x),
+                                   atol=1e-5)
+        with pytest.raises(KeyError):
+            S.predict(x, key='unknown')
+    finally:
+        release.set()
+        S.close()
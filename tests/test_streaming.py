@@ -0,0 +1,26 @@
+"""
+Tests of nnts.inference.StreamingPredictor.
+"""
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('kind', ['cnn', 'socnn'])
+def test_updates_match_full_recompute(inference, cnn_specs, socnn_specs, kind):
+    specs = cnn_specs if (kind == 'cnn') else socnn_specs()
+    S, P = inference.StreamingPredictor(specs), inference.Predictor(specs)
+    L = specs['input_length']
+    rows = np.random.RandomState(3).randn(5 * L, 4).astype(np.float32)
+    for t, row in enumerate(rows):
+        y = S.update(row)
+        if t < L - 1:
+            assert y is None
+        else:
+            np.testing.assert_allclose(y, P.predict(rows[t - L + 1: t + 1]), atol=1e-5)
+    # only the positions near the window's edges are recomputed per update
+    for geo, _ in S.geometry:
+        total = sum(g['length'] for g in geo)
+        recomputed = sum(min(g['left'] + g['right'], g['length']) for g in geo)
+        assert recomputed < total / 2
+    S.reset()
+    assert S.update(rows[0]) is None
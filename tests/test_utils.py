@@ -0,0 +1,39 @@
+"""
+Tests of nnts.utils generators.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('keras')
+from nnts import utils
+
+
+@pytest.mark.parametrize('kwargs', [dict(diff_column_names=['a', 'c']),
+                                    dict(diff_column_names=[], limit=1500),
+                                    dict(input_column_names=['a', 'c', 'd'], diff_column_names=['a', 'b'])])
+def test_user_streaming_matches_in_memory(tmp_path, kwargs):
+    rs = np.random.RandomState(0)
+    n = 2345
+    csv = os.path.join(str(tmp_path), 'user.csv')
+    pd.DataFrame({'a': np.cumsum(rs.randn(n)), 'b': rs.randn(n) * 5 + 3, 'c': np.cumsum(rs.rand(n)),
+                  'd': rs.randn(n)}).to_csv(csv, index=False)
+    A = utils.UserGenerator(csv, input_length=10, verbose=0, **kwargs)
+    B = utils.UserGenerator(csv, input_length=10, verbose=0, chunksize=100,
+                            store=os.path.join(str(tmp_path), 'user.npy'), **kwargs)
+    assert B.diffs == A.diffs
+    assert list(B.X.columns) == list(A.X.columns)
+    assert B.cols == A.cols
+    assert (B.n_train, B.n_valid) == (A.n_train, A.n_valid)
+    np.testing.assert_allclose(B.X.values, A.X.values, atol=1e-4)
+    np.testing.assert_allclose(B.means[A.cols], A.means[A.cols], atol=1e-6)
+    assert B.preprocessor().columns == A.preprocessor().columns
+
+
+def test_user_streaming_rejects_text_columns(tmp_path):
+    csv = os.path.join(str(tmp_path), 'user.csv')
+    pd.DataFrame({'a': np.arange(300.), 'day': ['x'] * 300}).to_csv(csv, index=False)
+    with pytest.raises(ValueError):
+        utils.UserGenerator(csv, input_length=10, input_column_names=['a'], verbose=0, chunksize=100,
+                            store=os.path.join(str(tmp_path), 'user.npy'))